@@ -42,10 +42,10 @@ def calculate_params(voltage: list, current: list, area: float, illum: float):
 
     params = {'J_sc': 0, 'V_oc': 0, 'R_sh': 0, 'R_s': 0, 'max_power': 0, 'V_mpp': 0, 'I_mpp': 0, 'PCE': 0, 'FF': 0}
 
-    # confirm order is low to high voltage
-    if not np.all(np.diff(voltage) > 0):
-        voltage = np.flipud(voltage)
-        current = np.flipud(current)
+    # confirm order is low to high voltage, scans can end anywhere past V_oc
+    order = np.argsort(voltage, kind='stable')
+    voltage = np.asarray(voltage, dtype=float)[order]
+    current = np.asarray(current, dtype=float)[order]
 
     V_oc = np.interp(0.0, current, voltage)  # if it doesn't cross, returns voltage[0] or voltage[-1]
     J_sc = np.interp(0.0, voltage, current)
@@ -68,7 +68,7 @@ def calculate_params(voltage: list, current: list, area: float, illum: float):
 
         # todo: gradient at each point is average of slope with prev point and slope with next point?
         J_grad = np.diff(current)
-        V_grad = np.absolute(voltage[0] - voltage[1])  # volt step same everywhere
+        V_grad = np.diff(voltage)  # volt step can vary (adaptive sweeps)
 
         # already know that the intercept is close enough, avoid index out of bounds
         if J_intercept == len(J_grad):
@@ -78,8 +78,8 @@ def calculate_params(voltage: list, current: list, area: float, illum: float):
             V_intercept -= 1
             print('Not enough values past 0mA', c=gui.WARNING)
 
-        R_sh = (V_grad / np.abs(J_grad[J_intercept])) * 1E3
-        R_s = (V_grad / np.abs(J_grad[V_intercept])) * 1E3
+        R_sh = (V_grad[J_intercept] / np.abs(J_grad[J_intercept])) * 1E3
+        R_s = (V_grad[V_intercept] / np.abs(J_grad[V_intercept])) * 1E3
 
         power = np.multiply(voltage, current)
 
@@ -102,3 +102,46 @@ def calculate_params(voltage: list, current: list, area: float, illum: float):
                   'I_mpp': I_mpp, 'PCE': PCE, 'FF': FF}
 
     return params
+
+
+def calculate_timing(voltage: list, timestamps: list):
+    """
+    Time a scan took and the rate it swept the voltage at, from the timestamp of each reading. Data is from one scan
+    (either forward or reverse)
+
+    :param voltage: volts
+    :param timestamps: seconds, any origin
+    :return: dict of sweep_time (s) and volt_rate (V/s), None if there are too few timestamps
+    """
+    if len(timestamps) < 2 or len(timestamps) != len(voltage):
+        return None
+
+    voltage = np.asarray(voltage, dtype=float)
+    timestamps = np.sort(np.asarray(timestamps, dtype=float))  # in the order the readings were taken
+
+    sweep_time = timestamps[-1] - timestamps[0]  # first reading to last
+    # range covered rather than distance travelled, an adaptive scan goes back to fill in points
+    volt_rate = np.ptp(voltage) / sweep_time if sweep_time > 0 else 0.0
+
+    return {'sweep_time': float(sweep_time), 'volt_rate': float(volt_rate)}
+
+
+def calculate_spo(voltage: list, current: list, area: float, illum: float, settled_fraction: float = 0.25):
+    """
+    Stabilized power output of a cell held at a fixed voltage, from the mean power of the end of the hold once the
+    cell has settled
+
+    :param voltage: volts, each reading of the hold
+    :param current: milli-amps
+    :param area: cm2
+    :param illum: mW/cm2
+    :param settled_fraction: fraction of the readings, from the end of the hold, that are averaged
+    :return: PCE (%), negative if the cell consumed power at the voltage held, None if there are no readings
+    """
+    if not len(voltage) or not len(current) or not area or not illum:
+        return None
+
+    settled = max(1, int(len(voltage) * settled_fraction))
+    power = np.mean(np.multiply(voltage[-settled:], current[-settled:]))  # negative while the cell generates
+
+    return float(-power / illum * 100 / area)
@@ -15,38 +15,267 @@ Updated on: August 19th, 2022
 Updated by: Seamus MacInnes
 """
 
+import asyncio
+import os
 import time
+from contextlib import contextmanager
+from datetime import datetime
 
 import numpy as np
 import pyvisa
+import recorder
+from presets import acquisition_options
+import simulator
 import source_meter_gui as gui
 
 # reroute print statements to the Alerts Multiline element in the gui
 print = gui.alert
 
-resource_name = 'GPIB::1'
-cancel_measure = False
+resource_name = 'GPIB::1'  # used when the profile does not name a resource
 
+# tests running on event loops, so cancel_tests() can reach them from the gui thread
+running_tests = {}  # asyncio task: event loop it runs on
+canceled_tests = set()
 
-def connect_to_instrument():
+# reading elements returned by :READ? for each data format
+# ascii keeps the default elements (VOLT,CURR,RES,TIME,STAT), the binary formats only transfer VOLT,CURR,TIME
+# the instrument's TIME timestamps the readings of a scan, see triggered_scans()
+reading_elements = {'ascii': 'VOLT,CURR,RES,TIME,STAT', 'sreal': 'VOLT,CURR,TIME', 'dreal': 'VOLT,CURR,TIME'}
+# struct datatype of the binary formats, 4 byte and 8 byte IEEE754 floats
+binary_datatypes = {'sreal': 'f', 'dreal': 'd'}
+
+# buffered lifetime logs store the instrument's timestamp with each reading
+log_elements = 'VOLT,CURR,TIME'
+buffer_size = 2500  # readings the Keithley 2420 trace buffer holds
+
+# data the sweeps return for every point, columns other than voltages and currents are saved alongside the data
+# timestamps are clock() readings while sweeping, run_iv() counts them from the start of the sweep
+point_columns = ['voltages', 'currents', 'settle_times', 'compliances', 'timestamps']
+
+# adaptive settling: two readings in a row agree within settle_tolerance of the current or this many amps
+settle_floor = 1e-6
+# settle times longer than this (s) are waited out on the host, where a cancel cuts them short, instead of in the
+# instrument's source delay where they block the :READ?
+host_settle_threshold = 0.5
+# most points the Keithley's source list holds, longer list sweeps are run in chunks of this size
+list_size = 100
+# pieces the forward scan on the sweep engine is run in when it stops past V_oc, each one is a round trip
+voc_segments = 10
+# longest wait (ms) for each attempt to turn the output off after a test is cut short, see turn_output_off()
+output_off_timeout = 2000
+
+# commands waiting to go out with the next write or query, joined into one program message with ';'
+pending_commands = {}  # pyvisa object: [command]
+max_message_length = 256  # characters per program message, longer batches are split
+
+# bus timing of the latest test on each instrument, see start_io_stats()
+io_stats = {}  # pyvisa object: stats
+# upper edges of the latency histogram bins (s), the last bin is open ended
+latency_bins = [1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0]
+
+# sessions being recorded, see recording()
+recordings = {}  # pyvisa object: (start time, [transaction])
+
+# last settings sent to each instrument, so a test only sends the ones that changed
+applied_settings = {}  # pyvisa object: {command header: value}
+# latest command with each of these headers, sent outside apply_settings(), restored by reconnect()
+restored_headers = (':SOUR:VOLT:LEV', ':OUTP')
+source_state = {}  # pyvisa object: {command header: command}
+
+# bus fault handling, see set_io_policy(): a failed transaction is retried after reconnecting, waiting backoff
+# seconds before the first retry and twice as long before each one after
+io_policies = {}  # pyvisa object: {'timeout': s, 'retries': count, 'backoff': s}
+default_io_policy = {'timeout': 2.0, 'retries': 0, 'backoff': 1.0}
+# instruments running a scan on the trigger model, the reconnect resets the scan so triggered_scans() retries the
+# whole scan instead of the transaction that failed
+scanning = set()
+interface_settings = {}  # pyvisa object: {attribute: value}, applied again when a session is reopened
+
+# compliance escalation, see set_compliance_policy(): a sweep that reaches the compliance current raises it by
+# step up to ceiling and measures the point again instead of stopping
+compliance_policies = {}  # pyvisa object: {'step': A, 'ceiling': A}
+
+# sessions are kept open between tests, loading the VISA library and opening a resource takes seconds
+resource_manager = None
+sessions = {}  # resource name: open pyvisa resource
+discovered_resources = None  # cached result of list_resources()
+
+
+def get_resource_manager():
+    """
+    Create the pyvisa ResourceManager on first use and reuse it afterwards
+
+    :return: pyvisa ResourceManager
+    """
+    global resource_manager
+    if resource_manager is None:
+        resource_manager = pyvisa.ResourceManager()
+    return resource_manager
+
+
+def list_instruments(refresh: bool = False):
+    """
+    Find the instruments connected to the PC. Discovery is slow so the result is cached until refreshed
+
+    :param refresh: search again instead of returning the cached result
+    :return: tuple of resource names (GPIB, USB, serial and TCPIP)
+    """
+    global discovered_resources
+    if discovered_resources is None or refresh:
+        try:
+            discovered_resources = get_resource_manager().list_resources()
+        except pyvisa.errors.VisaIOError:
+            discovered_resources = ()
+    return discovered_resources
+
+
+def is_alive(SrcMeter):
+    """
+    Cheap check that an open session still reaches the instrument, a serial poll instead of a full query
+
+    :param SrcMeter: pyvisa object for Keithley
+    :return: True if the instrument responded
+    """
+    try:
+        SrcMeter.read_stb()
+    except (pyvisa.errors.VisaIOError, pyvisa.errors.InvalidSession, NotImplementedError):
+        return False
+    return True
+
+
+def open_instrument(resource: str, baud_rate: int):
+    """
+    Open a resource and apply the settings its interface needs
+
+    :param resource: VISA resource name, e.g. GPIB::1, USB0::0x05E6::0x2420::1234::INSTR, ASRL3::INSTR or
+                     TCPIP0::192.168.0.10::gpib0,1::INSTR. SIM gives a simulated Keithley, REPLAY::<file> replays a
+                     recorded session with its original timing and REPLAY::<file>::ZERO replays it without delays
+    :param baud_rate: baud rate for serial resources, must match the Keithley's RS-232 setting
+    :return: Keithley as pyvisa object
+    """
+    if resource.upper().startswith('SIM'):
+        return simulator.SimulatedKeithley2420()
+    if resource.upper().startswith('REPLAY::'):
+        file_path = resource[len('REPLAY::'):]
+        timing = 'original'
+        if file_path.upper().endswith('::ZERO'):
+            file_path = file_path[:-len('::ZERO')]
+            timing = 'zero'
+        try:
+            return recorder.ReplayKeithley(file_path, timing, on_cancel=cancel_tests)
+        except (OSError, ValueError) as e:
+            print(f'Could not open recording: {e}', c=gui.ERROR)
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_resource_not_found)
+
+    SrcMeter = get_resource_manager().open_resource(resource)
+    if not isinstance(SrcMeter, pyvisa.resources.MessageBasedResource):
+        SrcMeter.close()
+        raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_nonsupported_operation)
+
+    settings = {}
+    if SrcMeter.interface_type == pyvisa.constants.InterfaceType.asrl:
+        # Keithley default RS-232 terminator is CR
+        settings = {'baud_rate': baud_rate, 'read_termination': '\r', 'write_termination': '\r'}
+    elif resource.upper().endswith('::SOCKET'):
+        # raw sockets have no end of message signal
+        settings = {'read_termination': '\n', 'write_termination': '\n'}
+    for attribute, value in settings.items():
+        setattr(SrcMeter, attribute, value)
+    interface_settings[SrcMeter] = settings
+
+    return SrcMeter
+
+
+def connect_to_instrument(resource: str = None, baud_rate: int = 9600):
     """
-    Connect to the Keithley 2420 SourceMeter
+    Connect to the Keithley 2420 SourceMeter. An open session to the same resource is reused if it still responds
 
+    :param resource: VISA resource name, defaults to resource_name
+    :param baud_rate: baud rate for serial resources
     :return: Keithley as pyvisa object
     """
+    resource = resource or resource_name
+
+    SrcMeter = sessions.get(resource)
+    if SrcMeter is not None:
+        if is_alive(SrcMeter):
+            return SrcMeter
+        disconnect_instrument(resource)
+
     print('Attempting connection...', c=gui.IMPORTANT)
     try:
-        rm = pyvisa.ResourceManager()
-        SrcMeter = rm.open_resource(resource_name)
-        if not isinstance(SrcMeter, pyvisa.resources.GPIBInstrument):
-            raise pyvisa.errors.VisaIOError
+        SrcMeter = open_instrument(resource, baud_rate)
     except pyvisa.errors.VisaIOError:
         print('Failed - Check connection and power', c=gui.ERROR)
+        if list_instruments():
+            print('Found instruments: ' + ', '.join(list_instruments()), c=gui.WARNING)
         return None
+    sessions[resource] = SrcMeter
     print('Success', c=gui.IMPORTANT)
     return SrcMeter
 
 
+def connect_switch(resource: str, SrcMeter=None):
+    """
+    Connect to the switch system that routes the Keithley to the pixels of a substrate, a Keithley 7001/7002 or
+    another switch taking :ROUT:CLOS and :ROUT:OPEN:ALL. An open session to the same resource is reused
+
+    :param resource: VISA resource name, SIM gives a simulated switch
+    :param SrcMeter: Keithley the switch is wired to, a simulated switch switches the cell of a simulated Keithley
+    :return: switch as pyvisa object, None if it could not be reached
+    """
+    if not resource:
+        print('Set switch_resource in the profile to scan pixels', c=gui.ERROR)
+        return None
+    if resource.upper().startswith('SIM'):
+        return simulator.SimulatedSwitch(SrcMeter if isinstance(SrcMeter, simulator.SimulatedKeithley2420) else None)
+
+    switch = sessions.get(resource)
+    if switch is not None:
+        if is_alive(switch):
+            return switch
+        disconnect_instrument(resource)
+
+    print('Connecting to switch...', c=gui.IMPORTANT)
+    try:
+        switch = open_instrument(resource, 9600)
+    except pyvisa.errors.VisaIOError:
+        print('Failed - Check switch connection and power', c=gui.ERROR)
+        return None
+    sessions[resource] = switch
+    return switch
+
+
+def disconnect_instrument(resource: str = None):
+    """
+    Close the session to an instrument and drop everything kept about it, so the pyvisa object is not held on to
+
+    :param resource: VISA resource name, defaults to resource_name
+    """
+    SrcMeter = sessions.pop(resource or resource_name, None)
+    if SrcMeter is None:
+        return
+    forget_settings(SrcMeter)
+    for kept in (io_stats, io_policies, interface_settings, compliance_policies):
+        kept.pop(SrcMeter, None)
+    try:
+        SrcMeter.close()
+    except (pyvisa.errors.VisaIOError, pyvisa.errors.InvalidSession):
+        pass
+
+
+def disconnect_all():
+    """
+    Close every open session and the ResourceManager
+    """
+    global resource_manager
+    for resource in list(sessions):
+        disconnect_instrument(resource)
+    if resource_manager is not None:
+        resource_manager.close()
+        resource_manager = None
+
+
 def test_communication(SrcMeter):
     """
     Check communication with Keithley
@@ -67,199 +296,1772 @@ def test_communication(SrcMeter):
     return True
 
 
-def run_IV_test(SrcMeter, profile):
+@contextmanager
+def cancellable():
     """
-    returns voltage (V) and current (mA)
-
-    :param SrcMeter: pyvisa object for Keithley
-    :param profile: test parameters
-    :return: voltages, currents, time and volt rate
+    Register the current task so cancel_tests() reaches it. A test started inside another test (a sweep of a
+    lifetime run) shares the registration of the outer one
     """
-    if not SrcMeter or not profile:
-        return [], [], 0, 0
+    task = asyncio.current_task()
+    if task in running_tests:
+        yield
+        return
 
-    start_volt = float(profile['start_volt'])
-    stop_volt = float(profile['stop_volt'])
-    volt_step = abs(float(profile['volt_step']))
-    curr_limit = abs(float(profile['curr_limit'])) / 1000  # mA to A
-    settle_time = abs(float(profile['settle_time']))
-    hysteresis = profile['hysteresis']
+    running_tests[task] = asyncio.get_running_loop()
+    try:
+        yield
+    finally:
+        running_tests.pop(task, None)
+        canceled_tests.discard(task)
 
-    if start_volt > stop_volt:
-        volt_step = -volt_step
 
-    volt_range = max(abs(start_volt), abs(stop_volt))
-    voltage_points = np.arange(start_volt, stop_volt+volt_step/2, volt_step)
+def cancel_tests():
+    """
+    Cancel every running test. Safe to call from any thread, takes effect at the next await of each test so a
+    settle delay is cut short straight away. A test already canceled is left alone so a second press during its
+    teardown does not interrupt turning the output off
+    """
+    canceling = [(task, loop) for task, loop in running_tests.items() if task not in canceled_tests]
+    if canceling:
+        # mark where the cancel landed, a replay cancels the test at the same point even if it was between
+        # transactions (waiting on a scan or a settle delay)
+        for start, transactions in list(recordings.values()):
+            transactions.append((time.perf_counter() - start, 0.0, 'cancel', '', None))
+    for task, loop in canceling:
+        canceled_tests.add(task)
+        loop.call_soon_threadsafe(task.cancel)
 
-    if hysteresis:
-        voltage_points = np.concatenate((voltage_points, np.flip(voltage_points)))
 
-    print("Running test...", c=gui.IMPORTANT)
+def is_canceled():
+    """
+    :return: True if the test running in the current task has been canceled
+    """
+    return asyncio.current_task() in canceled_tests
 
-    voltages = []
-    currents = []
-    elapsed = 0
-    volt_rate = 0
 
+async def call(function, *args, **kwargs):
+    """
+    Run a blocking pyvisa call in a worker thread so the event loop is free while waiting on the bus.
+    A transaction that has started is allowed to finish before a cancellation is raised, leaving the bus free to
+    turn the output off
+
+    :param function: pyvisa method, e.g. SrcMeter.write
+    :return: what the function returns
+    """
+    transaction = asyncio.ensure_future(asyncio.to_thread(function, *args, **kwargs))
     try:
-        # configure meter for voltage testing
-        SrcMeter.write('*RST')  # Reset GPIB Defaults
-        SrcMeter.write(':SYST:BEEP:STAT OFF')  # Turn off beeper
-        SrcMeter.write(':SYST:RSEN OFF')  # Turn off 4-wire sensing
-        SrcMeter.write(':SOUR:FUNC VOLT')  # Set voltage mode
-        SrcMeter.write(':SOUR:VOLT:MODE FIX')  # Fixed source mode
-        SrcMeter.write(':SENS:FUNC "CURR"')  # Set-up current measurement
-        SrcMeter.write(':SOUR:VOLT:RANG ' + str(volt_range))  # Set acceptable voltage range
-        SrcMeter.write(':SENS:CURR:PROT ' + str(curr_limit))  # Set compliance current range
-        SrcMeter.write(':SOUR:VOLT:LEV 0')  # start at 0V
-        SrcMeter.write(':OUTP ON')  # turn on output
-
-        start = time.time()
-
-        # set and then measure I and V for each point
-        for voltage in voltage_points:
-            if cancel_measure:
-                print('Canceled', c=gui.WARNING)
-                break
+        return await asyncio.shield(transaction)
+    except asyncio.CancelledError:
+        await asyncio.wait([transaction])
+        raise
 
-            SrcMeter.write(':SOUR:VOLT:LEV ' + str(voltage))
-            time.sleep(settle_time)
 
-            result = SrcMeter.query(':READ?').split(',')  # todo: add timeout? no parameter for that
-            try:
-                voltages.append(float(result[0]))  # Volts
-                currents.append(float(result[1]) * 1000)  # Amps to milli-amps
+def queue_command(SrcMeter, command: str):
+    """
+    Hold a command back so it goes out in the same transaction as the next write or query
 
-                # check against current limit (in amps) with tolerance of 0.1mA
-                if abs(float(result[1])) >= curr_limit - 1e-4:
-                    print('Current limit reached', c=gui.ERROR)
-                    break
+    :param SrcMeter: pyvisa object for Keithley
+    :param command: command with parameters
+    """
+    pending_commands.setdefault(SrcMeter, []).append(command)
 
-            except (ValueError, IndexError):
-                print('Unexpected Response', c=gui.ERROR)
-                break
 
+def take_messages(SrcMeter, command: str):
+    """
+    Join the queued commands and command into as few program messages as fit in max_message_length
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param command: command that goes out last
+    :return: program messages in order
+    """
+    commands = pending_commands.pop(SrcMeter, []) + [command]
+    messages = [commands[0]]
+    for command in commands[1:]:
+        if len(messages[-1]) + 1 + len(command) <= max_message_length:
+            messages[-1] += ';' + command
         else:
-            print('Completed', c=gui.COMPLETE)
+            messages.append(command)
+    return messages
 
-        elapsed = time.time() - start  # printing the outcome takes ~1ms
 
-        SrcMeter.write(":OUTP OFF")  # Turn off the source output
+async def transaction(SrcMeter, function, command: str, **kwargs):
+    """
+    Send command with any queued commands in front of it, counting each bus transaction. If the bus fails the
+    instrument is reconnected and restored and the messages are sent again, as set by set_io_policy(), so a point
+    is read again at the same voltage. The transactions of a scan are retried by triggered_scans() instead
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param function: pyvisa method taking the program message, e.g. SrcMeter.query
+    :param command: command that goes out last, its response is returned
+    :return: what the function returns
+    """
+    *earlier, last = messages = take_messages(SrcMeter, command)
+    policy = io_policies.get(SrcMeter, default_io_policy)
+    retries = 0 if SrcMeter in scanning else policy['retries']
 
-        volt_range = abs(stop_volt - start_volt) * 2 if hysteresis else abs(stop_volt - start_volt)
-        volt_rate = volt_range / elapsed
+    for attempt in range(retries + 1):
+        try:
+            if attempt:
+                await reconnect(SrcMeter)
+            for message in earlier:
+                await timed_call(SrcMeter, SrcMeter.write, message)
+            response = await timed_call(SrcMeter, function, last, **kwargs)
+        except pyvisa.errors.VisaIOError as e:
+            await retry_pause(SrcMeter, e, attempt, retries, policy['backoff'])
+            continue
 
-    except pyvisa.errors.VisaIOError as e:
-        print('Communication Failure', c=gui.ERROR)
-        print(e, c=gui.ERROR)
+        remember_source_state(SrcMeter, messages)
+        return response
 
 
-    return voltages, currents, elapsed, volt_rate
+async def retry_pause(SrcMeter, error: pyvisa.errors.VisaIOError, attempt: int, retries: int, backoff: float):
+    """
+    Wait before retrying after a bus fault, twice as long as before the last retry. The fault is raised again once
+    the retries are used up, or straight away if it is a replay that diverged
 
-def run_lifespan_test(SrcMeter, profile):
+    :param SrcMeter: pyvisa object for Keithley
+    :param error: the fault
+    :param attempt: attempts made so far, less one
+    :param retries: retries allowed
+    :param backoff: wait before the first retry (s)
     """
-    returns voltage (V) and current (mA)
+    if attempt == retries or isinstance(error, recorder.ReplayError):
+        raise error
+    delay = backoff * 2 ** attempt
+    print(f'Bus fault: {error}', c=gui.WARNING)
+    print(f'Reconnecting in {delay:g}s (retry {attempt + 1} of {retries})', c=gui.WARNING)
+    await pause(SrcMeter, delay)
+
+
+def remember_source_state(SrcMeter, messages: list):
+    """
+    Keep the latest command with each of restored_headers, for reconnect()
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param messages: program messages that were sent
+    """
+    state = source_state.setdefault(SrcMeter, {})
+    for message in messages:
+        for command in message.split(';'):
+            header = command.split(' ', 1)[0]
+            if header in restored_headers:
+                state[header] = command
+
+
+async def reconnect(SrcMeter):
+    """
+    Reopen the session to an instrument after a bus fault and put it back the way the test left it: a device
+    clear, then a reset followed by every applied setting, the source level and the output state. If nothing is
+    known about the state of the instrument it is left for the next test to reset
+
+    :param SrcMeter: pyvisa object for Keithley
+    """
+    timeout = SrcMeter.timeout
+    try:
+        await call(SrcMeter.close)
+    except (pyvisa.errors.VisaIOError, pyvisa.errors.InvalidSession):
+        pass  # the session may already be gone
+    await call(SrcMeter.open)
+    SrcMeter.timeout = timeout
+    for attribute, value in interface_settings.get(SrcMeter, {}).items():
+        setattr(SrcMeter, attribute, value)
+    await call(SrcMeter.clear)
+
+    applied = applied_settings.get(SrcMeter)
+    if applied is None:
+        return
+    state = source_state.get(SrcMeter, {})
+    commands = ['*RST'] + [header + ' ' + value for header, value in applied.items()]
+    commands += [state[header] for header in restored_headers if header in state]
+    for command in commands[:-1]:
+        queue_command(SrcMeter, command)
+    for message in take_messages(SrcMeter, commands[-1]):
+        await timed_call(SrcMeter, SrcMeter.write, message)
+
+
+async def timed_call(SrcMeter, function, message: str, **kwargs):
+    """
+    Make one bus transaction, recording its latency and size in io_stats
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param function: pyvisa method taking the program message
+    :param message: program message
+    :return: what the function returns
+    """
+    sent = time.perf_counter()
+    try:
+        response = await call(function, message, **kwargs)
+    except pyvisa.errors.VisaIOError as e:
+        record_session(SrcMeter, function, message, sent, {'error': int(e.error_code)})
+        raise
+    except asyncio.CancelledError:
+        record_session(SrcMeter, function, message, sent, {'canceled': True})
+        raise
+    record_transaction(SrcMeter, message, time.perf_counter() - sent, response)
+    record_session(SrcMeter, function, message, sent, response)
+    return response
+
+
+@contextmanager
+def recording(SrcMeter, profile, kind: str):
+    """
+    Record every bus transaction of a test when the profile has a record_dir, saving them there when the test ends
+    as '<date> <time> <kind> session.jsonl.gz', see recorder.save_session(). The instrument is reset at the start
+    so a replay of the recording begins from the same state
 
     :param SrcMeter: pyvisa object for Keithley
     :param profile: test parameters
-    :return: voltages, currents, time and volt rate
+    :param kind: test being recorded, e.g. 'iv' or 'lifetime'
     """
-    if not SrcMeter or not profile:
-        return [], [], 0, 0
+    record_dir = profile.get('record_dir') if SrcMeter and profile else None
+    if not record_dir or isinstance(SrcMeter, recorder.ReplayKeithley):
+        yield
+        return
 
-    start_volt = float(profile['start_volt'])
-    stop_volt = float(profile['stop_volt'])
-    volt_step = abs(float(profile['volt_step']))
-    curr_limit = abs(float(profile['curr_limit'])) / 1000  # mA to A
-    settle_time = abs(float(profile['settle_time']))
-    hysteresis = profile['hysteresis']
+    forget_settings(SrcMeter)
+    recordings[SrcMeter] = (time.perf_counter(), [])
+    try:
+        yield
+    finally:
+        transactions = recordings.pop(SrcMeter)[1]
+        file_name = ' '.join([datetime.now().strftime('%Y-%m-%d %H-%M-%S'), kind, 'session.jsonl.gz'])
+        file_path = os.path.join(record_dir, file_name)
+        try:
+            os.makedirs(record_dir, exist_ok=True)
+            recorder.save_session(file_path, transactions, kind)
+            print(f'Recorded {len(transactions)} transactions to {file_name}', c=gui.COMPLETE)
+        except OSError as e:
+            print(f'Could not save recording: {e}', c=gui.ERROR)
 
-    if start_volt > stop_volt:
-        volt_step = -volt_step
 
-    volt_range = max(abs(start_volt), abs(stop_volt))
-    voltage_points = np.arange(start_volt, stop_volt+volt_step/2, volt_step)
+def record_session(SrcMeter, function, message: str, sent: float, response):
+    """
+    Add a transaction to the recording of an instrument, if it is being recorded
 
-    if hysteresis:
-        voltage_points = np.concatenate((voltage_points, np.flip(voltage_points)))
+    :param SrcMeter: pyvisa object for Keithley
+    :param function: pyvisa method called
+    :param message: program message sent
+    :param sent: time.perf_counter() when the message went out
+    :param response: what the pyvisa method returned, or the error or cancellation that ended it
+    """
+    session = recordings.get(SrcMeter)
+    if session is None:
+        return
+    start, transactions = session
+    transactions.append((sent - start, time.perf_counter() - sent, function.__name__, message, response))
 
-    print("Running test...", c=gui.IMPORTANT)
 
-    voltages2 = []
-    currents2 = []
-    elapsed2 = 0
-    volt_rate2 = 0
+def clock(SrcMeter):
+    """
+    Read the host clock for a test to decide by, time.perf_counter(). The reading is recorded along with the
+    transactions so a replay makes the same decisions: it gets the recorded reading instead
+
+    :param SrcMeter: pyvisa object for Keithley
+    :return: seconds, only differences between readings are meaningful
+    """
+    if isinstance(SrcMeter, recorder.ReplayKeithley):
+        return SrcMeter.clock()
+    now = time.perf_counter()
+    session = recordings.get(SrcMeter)
+    if session is not None:
+        start, transactions = session
+        transactions.append((now - start, 0.0, 'clock', '', now - start))
+    return now
+
+
+async def pause(SrcMeter, delay: float):
+    """
+    Wait on the host, where a cancel cuts the wait short. A replay without timing does not wait
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param delay: seconds
+    """
+    if isinstance(SrcMeter, recorder.ReplayKeithley):
+        delay = SrcMeter.host_delay(delay)
+    await asyncio.sleep(max(delay, 0.0))
+
+
+def start_io_stats(SrcMeter):
+    """
+    Start recording the bus transactions of a test, replacing the stats of the last one
+
+    :param SrcMeter: pyvisa object for Keithley
+    """
+    io_stats[SrcMeter] = {'phase': None, 'phase_start': 0.0, 'phases': {}, 'commands': {}, 'running': True}
+
 
+@contextmanager
+def io_timing(SrcMeter):
+    """
+    Time the bus transactions of a test in io_stats and show the report in the alerts when it ends. A test run
+    inside another one (the sweeps of a lifetime test) adds to the stats of the outer one, reported once at its end
+
+    :param SrcMeter: pyvisa object for Keithley
+    """
+    stats = io_stats.get(SrcMeter)
+    if stats and stats['running']:
+        yield
+        return
+
+    start_io_stats(SrcMeter)
     try:
-        # configure meter for voltage testing
-        SrcMeter.write('*RST')  # Reset GPIB Defaults
-        SrcMeter.write(':SYST:BEEP:STAT OFF')  # Turn off beeper
-        SrcMeter.write(':SYST:RSEN OFF')  # Turn off 4-wire sensing
-        SrcMeter.write(':SOUR:FUNC VOLT')  # Set voltage mode
-        SrcMeter.write(':SOUR:VOLT:MODE FIX')  # Fixed source mode
-        SrcMeter.write(':SENS:FUNC "CURR"')  # Set-up current measurement
-        SrcMeter.write(':SOUR:VOLT:RANG ' + str(volt_range))  # Set acceptable voltage range
-        SrcMeter.write(':SENS:CURR:PROT ' + str(curr_limit))  # Set compliance current range
-        SrcMeter.write(':SOUR:VOLT:LEV 0')  # start at 0V
-        SrcMeter.write(':OUTP ON')  # turn on output
-
-        start = time.time()
-
-        # set and then measure I and V for each point
-        for voltage in voltage_points:
-            if cancel_measure:
-                print('Canceled', c=gui.WARNING)
-                break
+        yield
+    finally:
+        set_phase(SrcMeter, None)
+        if SrcMeter in io_stats:  # unless the instrument was disconnected meanwhile
+            io_stats[SrcMeter]['running'] = False
+        print_io_report(io_report(SrcMeter))
 
-            SrcMeter.write(':SOUR:VOLT:LEV ' + str(voltage))
-            time.sleep(settle_time)
 
-            result = SrcMeter.query(':READ?').split(',')  # todo: add timeout? no parameter for that
-            try:
-                voltages.append(float(result[0]))  # Volts
-                currents.append(float(result[1]) * 1000)  # Amps to milli-amps
+def set_phase(SrcMeter, phase: str = None):
+    """
+    Close the current phase of the test and start the next one, wall time and bus time are totalled per phase
 
-                # check against current limit (in amps) with tolerance of 0.1mA
-                if abs(float(result[1])) >= curr_limit - 1e-4:
-                    print('Current limit reached', c=gui.ERROR)
-                    break
+    :param SrcMeter: pyvisa object for Keithley
+    :param phase: e.g. 'configure', 'sweep' or 'teardown', None to stop timing
+    """
+    stats = io_stats.get(SrcMeter)
+    if stats is None:
+        return
 
-            except (ValueError, IndexError):
-                print('Unexpected Response', c=gui.ERROR)
-                break
+    now = time.perf_counter()
+    if stats['phase']:
+        stats['phases'][stats['phase']]['time'] += now - stats['phase_start']
+    stats['phase'] = phase
+    stats['phase_start'] = now
+    if phase:
+        stats['phases'].setdefault(phase, {'time': 0.0, 'bus_time': 0.0, 'transactions': 0})
+
+
+def record_transaction(SrcMeter, message: str, latency: float, response):
+    """
+    Add a transaction to io_stats, under the headers of its program message
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param message: program message sent
+    :param latency: seconds from sending to the response or the end of the write
+    :param response: what the pyvisa method returned
+    """
+    stats = io_stats.get(SrcMeter)
+    if stats is None:
+        return
+
+    headers = [command.split(' ')[0] for command in message.split(';')]
+    name = ';'.join(headers) if len(headers) <= 3 else f'{headers[0]};...;{headers[-1]}'
+    command = stats['commands'].setdefault(name, {'latencies': [], 'bytes_written': 0, 'bytes_read': 0})
+    command['latencies'].append(latency)
+    command['bytes_written'] += len(message) + 1  # with the termination character
+    if isinstance(response, str):
+        command['bytes_read'] += len(response) + 1
+    elif isinstance(response, np.ndarray):
+        command['bytes_read'] += response.nbytes
+
+    if stats['phase']:
+        phase = stats['phases'][stats['phase']]
+        phase['bus_time'] += latency
+        phase['transactions'] += 1
+
+
+def io_report(SrcMeter):
+    """
+    Summarize the bus transactions of the latest test on an instrument
+
+    :param SrcMeter: pyvisa object for Keithley
+    :return: list of rows, one per phase then one per command, None if nothing was recorded
+    """
+    stats = io_stats.get(SrcMeter)
+    if not stats or not stats['commands']:
+        return None
+
+    rows = []
+    for name, phase in stats['phases'].items():
+        rows.append({'Type': 'phase', 'Name': name, 'Count': phase['transactions'],
+                     'Total Time (s)': phase['time'], 'Bus Time (s)': phase['bus_time']})
+
+    edges = [0.0] + latency_bins + [np.inf]
+    for name, command in stats['commands'].items():
+        latencies = np.array(command['latencies'])
+        row = {'Type': 'command', 'Name': name, 'Count': latencies.size, 'Bus Time (s)': latencies.sum(),
+               'Mean (ms)': latencies.mean() * 1000, 'Median (ms)': np.median(latencies) * 1000,
+               'P95 (ms)': np.percentile(latencies, 95) * 1000, 'Max (ms)': latencies.max() * 1000,
+               'Bytes Written': command['bytes_written'], 'Bytes Read': command['bytes_read']}
+        counts = np.histogram(latencies, edges)[0]
+        for upper, count in zip(edges[1:], counts):
+            row[f'< {upper * 1000:g} ms' if np.isfinite(upper) else f'>= {edges[-2] * 1000:g} ms'] = int(count)
+        rows.append(row)
+    return rows
+
+
+def print_io_report(rows: list):
+    """
+    Show an io_report() in the alerts: time per phase, then the latency of each command with its histogram
+    """
+    if not rows:
+        return
 
+    for row in rows:
+        if row['Type'] == 'phase':
+            print(f"{row['Name']}: {row['Total Time (s)']:.3f}s, {row['Bus Time (s)']:.3f}s on the bus in "
+                  f"{row['Count']} transactions")
         else:
-            print('Completed', c=gui.COMPLETE)
+            histogram = ', '.join(f'{key} {value}' for key, value in row.items() if key.startswith(('<', '>='))
+                                  and value)
+            print(f"{row['Name']} x{row['Count']}: mean {row['Mean (ms)']:.2f}ms, p95 {row['P95 (ms)']:.2f}ms, "
+                  f"max {row['Max (ms)']:.2f}ms, {row['Bytes Written']}B out, {row['Bytes Read']}B in "
+                  f"({histogram})")
 
-        elapsed = time.time() - start  # printing the outcome takes ~1ms
 
-        SrcMeter.write(":OUTP OFF")  # Turn off the source output
+async def write(SrcMeter, command: str):
+    await transaction(SrcMeter, SrcMeter.write, command)
 
-        volt_range = abs(stop_volt - start_volt) * 2 if hysteresis else abs(stop_volt - start_volt)
-        volt_rate = volt_range / elapsed
 
-    except pyvisa.errors.VisaIOError as e:
-        print('Communication Failure', c=gui.ERROR)
-        print(e, c=gui.ERROR)
-
-
-    return voltages, currents, elapsed, volt_rate
-
-# Sweep operation - all data comes in one read
-# SrcMeter.write('*RST')
-# SrcMeter.write(':SENS:FUNC:CONC OFF')
-# SrcMeter.write(':SOUR:FUNC VOLT')
-# SrcMeter.write(':SENS:FUNC \'CURR:DC\'')
-# SrcMeter.write(':SENS:CURR:PROT 0.1')
-# SrcMeter.write(':SOUR:VOLT:START 1E-3')
-# SrcMeter.write(':SOUR:VOLT:STOP 10E-3')
-# SrcMeter.write(':SOUR:VOLT:STEP 1E-3')
-# SrcMeter.write(':SOUR:VOLT:MODE SWE')
-# SrcMeter.write(':SOUR:SWE:RANG AUTO')
-# SrcMeter.write(':SOUR:SWE:SPAC LIN')
-# SrcMeter.write(':TRIG:COUN 10')
-# SrcMeter.write(':SOUR:DEL 0.1')
-# SrcMeter.write(':OUTP ON')
-# output = SrcMeter.query(':READ?')
-# print(output)
-# SrcMeter.write(':OUTP OFF')
+async def query(SrcMeter, command: str):
+    return await transaction(SrcMeter, SrcMeter.query, command)
+
+
+async def apply_settings(SrcMeter, settings: dict):
+    """
+    Queue only the settings that differ from the ones last applied to this instrument, they go out with the next
+    write or query. The instrument is reset first when nothing is known about its state: a new session or a
+    session that has had an error
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param settings: command header: value, sent in order as '<header> <value>'
+    """
+    applied = applied_settings.get(SrcMeter)
+    if applied is None:
+        pending_commands.pop(SrcMeter, None)
+        queue_command(SrcMeter, '*RST')  # Reset GPIB Defaults
+        applied = applied_settings[SrcMeter] = {}
+
+    for header, value in settings.items():
+        if applied.get(header) != value:
+            queue_command(SrcMeter, header + ' ' + value)
+            applied[header] = value
+
+
+async def turn_output_off(SrcMeter):
+    """
+    Turn off the source output after a test was cut short, in bounded time: commands still waiting to go out are
+    dropped, an acquisition still running is aborted and each attempt gets output_off_timeout. If the instrument
+    does not respond it is cleared (a device clear stops whatever it is doing) and the write is tried once more
+
+    :param SrcMeter: pyvisa object for Keithley
+    """
+    if pending_commands.pop(SrcMeter, None):
+        forget_settings(SrcMeter)  # queued settings never reached the instrument
+
+    timeout = SrcMeter.timeout
+    SrcMeter.timeout = output_off_timeout if timeout is None else min(timeout, output_off_timeout)
+    try:
+        for attempt in range(2):
+            try:
+                await timed_call(SrcMeter, SrcMeter.write, ':ABOR;:OUTP OFF')  # no retries, see transaction()
+                return
+            except pyvisa.errors.VisaIOError:
+                forget_settings(SrcMeter)
+                if attempt == 0:
+                    try:
+                        await call(SrcMeter.clear)
+                    except pyvisa.errors.VisaIOError:
+                        pass
+        print('Could not turn the output off - check the instrument', c=gui.ERROR)
+    finally:
+        SrcMeter.timeout = timeout
+
+
+def communication_failure(SrcMeter, error: pyvisa.errors.VisaIOError):
+    """
+    Report a bus fault that outlasted its retries, the instrument is reset before its next test
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param error: the fault
+    """
+    forget_settings(SrcMeter)
+    print('Communication Failure', c=gui.ERROR)
+    print(error, c=gui.ERROR)
+
+
+def forget_settings(SrcMeter):
+    """
+    Mark the state of an instrument as unknown so it is reset before its next test
+
+    :param SrcMeter: pyvisa object for Keithley
+    """
+    applied_settings.pop(SrcMeter, None)
+    pending_commands.pop(SrcMeter, None)
+    source_state.pop(SrcMeter, None)
+
+
+def set_io_policy(SrcMeter, profile):
+    """
+    Set how long a transaction may take and how bus faults are retried for the tests on an instrument, from the
+    profile's query_timeout (s, on top of the time the instrument takes to measure, see extend_timeout()),
+    retries and retry_backoff (s)
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters
+    """
+    policy = io_policies[SrcMeter] = {'timeout': abs(float(profile.get('query_timeout', 2.0))),
+                                      'retries': abs(int(profile.get('retries', 3))),
+                                      'backoff': abs(float(profile.get('retry_backoff', 1.0)))}
+    SrcMeter.timeout = 1000 * policy['timeout']
+
+
+def set_compliance_policy(SrcMeter, profile):
+    """
+    Set how the sweeps on an instrument escalate the compliance current, from the profile's compliance_step and
+    compliance_ceiling (mA). Escalation is off while either is 0 or the ceiling is not above curr_limit
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters
+    """
+    compliance_policies[SrcMeter] = {'step': abs(float(profile.get('compliance_step') or 0)) / 1000,  # mA to A
+                                     'ceiling': abs(float(profile.get('compliance_ceiling') or 0)) / 1000}
+
+
+def compliance_limit(SrcMeter, curr_limit: float):
+    """
+    :param SrcMeter: pyvisa object for Keithley
+    :param curr_limit: compliance current the test was configured with (A)
+    :return: compliance current set on the instrument (A), higher than curr_limit once it has been raised
+    """
+    return float(applied_settings.get(SrcMeter, {}).get(':SENS:CURR:PROT', curr_limit))
+
+
+async def raise_compliance(SrcMeter, curr_limit: float, voltage: float):
+    """
+    Raise the compliance current by a step of the instrument's compliance policy, see set_compliance_policy(). A
+    fixed current range below the new compliance is raised with it, the range caps the compliance
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param curr_limit: compliance current that was reached (A)
+    :param voltage: voltage it was reached at (V), for the log
+    :return: the new compliance current (A), None if escalation is off or the ceiling was reached
+    """
+    policy = compliance_policies.get(SrcMeter)
+    if not policy or not policy['step'] or curr_limit >= policy['ceiling']:
+        return None
+
+    new_limit = round(min(curr_limit + policy['step'], policy['ceiling']), 9)
+    settings = {':SENS:CURR:PROT': str(new_limit)}
+    applied = applied_settings.get(SrcMeter, {})
+    if applied.get(':SENS:CURR:RANG:AUTO') == 'OFF' and float(applied.get(':SENS:CURR:RANG', 0)) < new_limit:
+        settings[':SENS:CURR:RANG'] = str(new_limit)
+    await apply_settings(SrcMeter, settings)
+    print(f'Compliance raised to {new_limit * 1000:g}mA at {voltage:g}V', c=gui.WARNING)
+    return new_limit
+
+
+def extend_timeout(SrcMeter, seconds: float):
+    """
+    Make sure a single transaction can take seconds plus the query timeout without timing out (a timeout of None
+    never expires)
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param seconds: longest time the instrument takes to respond (s)
+    """
+    if SrcMeter.timeout is not None:
+        base = io_policies.get(SrcMeter, default_io_policy)['timeout']
+        SrcMeter.timeout = max(SrcMeter.timeout, 1000 * (base + seconds))
+
+
+def source_settings(volt_range: float, curr_limit: float, data_format: str = 'ascii'):
+    """
+    Settings to source voltage and measure current
+
+    :param volt_range: largest absolute voltage that will be sourced (V)
+    :param curr_limit: compliance current (A)
+    :param data_format: format readings are transferred in: 'ascii', 'sreal' or 'dreal'
+    :return: settings for apply_settings()
+    """
+    return {':SYST:BEEP:STAT': 'OFF',  # Turn off beeper
+            ':SYST:RSEN': 'OFF',  # Turn off 4-wire sensing
+            ':SOUR:FUNC': 'VOLT',  # Set voltage mode
+            ':SENS:FUNC': '"CURR"',  # Set-up current measurement
+            ':SOUR:VOLT:RANG': str(volt_range),  # Set acceptable voltage range
+            ':SENS:CURR:PROT': str(curr_limit),  # Set compliance current range
+            ':FORM:ELEM': reading_elements[data_format],  # Elements returned for each reading
+            ':FORM:DATA': 'ASC' if data_format == 'ascii' else data_format.upper(),
+            ':FORM:BORD': 'NORM'}  # Binary values are big endian
+
+
+def acquisition_settings(options: dict):
+    """
+    Settings for the integration time, autozero and current range
+
+    :param options: see acquisition_options()
+    :return: settings for apply_settings()
+    """
+    settings = {':SENS:CURR:NPLC': str(options['nplc']),  # Integration time in power line cycles
+                ':SYST:AZER': options['autozero']}  # Autozero doubles the time of each reading
+    if options['curr_range']:
+        settings[':SENS:CURR:RANG:AUTO'] = 'OFF'
+        settings[':SENS:CURR:RANG'] = str(options['curr_range'] / 1000)  # mA to A
+    else:
+        settings[':SENS:CURR:RANG:AUTO'] = 'ON'
+    return settings
+
+
+def integration_time(options: dict, line_frequency: float = 50.0):
+    """
+    Time the Keithley integrates for each reading, doubled by autozero. The default 50Hz line gives the longest time
+
+    :param options: see acquisition_options()
+    :param line_frequency: power line frequency (Hz), 60 for the shortest time
+    :return: seconds
+    """
+    integration = options['nplc'] / line_frequency
+    return 2 * integration if options['autozero'] == 'ON' else integration
+
+
+def reading_time(options: dict):
+    """
+    Longest time one reading takes: integration plus overhead
+
+    :param options: see acquisition_options()
+    :return: seconds
+    """
+    return integration_time(options) + 0.05
+
+
+def log_settings(count: int, interval: float):
+    """
+    Settings for a fixed bias log in the trace buffer: the trigger model takes count readings interval apart and
+    stores them with their timestamps
+
+    :param count: number of readings, at most buffer_size
+    :param interval: trigger delay between readings (s)
+    :return: settings for apply_settings()
+    """
+    return {':SOUR:VOLT:MODE': 'FIX',
+            ':SOUR:DEL:AUTO': 'ON',
+            ':TRIG:COUN': str(count),
+            ':TRIG:DEL': str(interval),  # Delay before each reading, on top of the reading time
+            ':FORM:ELEM': log_elements,
+            ':TRAC:FEED': 'SENS',  # Store raw readings
+            ':TRAC:POIN': str(count)}
+
+
+def sweep_settings(voltage_points, settle_time: float):
+    """
+    Settings for the Keithley's sweep engine, the start and stop voltage are set for each scan
+
+    :param voltage_points: voltages of the first scan in order (V), must be evenly spaced
+    :param settle_time: source delay at each point (s)
+    :return: settings for apply_settings()
+    """
+    volt_step = voltage_points[1] - voltage_points[0] if len(voltage_points) > 1 else 0
+    return {':SOUR:VOLT:MODE': 'SWE',  # Sweep source mode
+            ':SOUR:SWE:RANG': 'BEST',  # Single fixed range for the whole sweep
+            ':SOUR:SWE:SPAC': 'LIN',  # Linear steps
+            ':SOUR:VOLT:STEP': str(abs(volt_step)),
+            ':TRIG:COUN': str(len(voltage_points)),  # One trigger per sweep point
+            ':TRIG:DEL': '0',
+            ':SOUR:DEL:AUTO': 'OFF',
+            ':SOUR:DEL': str(settle_time)}  # Settle time on the instrument
+
+
+def list_settings(settle_time: float):
+    """
+    Settings for sweeping the Keithley's source list, the voltages and trigger count are set for each chunk by
+    list_chunks()
+
+    :param settle_time: source delay at each point (s)
+    :return: settings for apply_settings()
+    """
+    return {':SOUR:VOLT:MODE': 'LIST',  # List source mode
+            ':TRIG:DEL': '0',
+            ':SOUR:DEL:AUTO': 'OFF',
+            ':SOUR:DEL': str(settle_time)}  # Settle time on the instrument
+
+
+def load_voltage_list(file_path: str):
+    """
+    Read the voltages of a list sweep from the first column of a CSV or text file, header rows and blank cells are
+    skipped, so the voltages of a saved data file can be swept again
+
+    :param file_path: path of the file
+    :return: NumPy array of voltages (V)
+    """
+    voltages = np.genfromtxt(file_path, delimiter=',', usecols=0, ndmin=1)
+    voltages = voltages[~np.isnan(voltages)]
+    if not voltages.size:
+        raise ValueError(f'No voltages in {file_path}')
+    return voltages
+
+
+def source_delay(settle_time: float, settle_tolerance: float = None):
+    """
+    Source delay for a PC driven sweep, see point_settings() and read_point()
+
+    :param settle_time: delay between setting the voltage and measuring (s)
+    :param settle_tolerance: given for adaptive settling
+    :return: settle_time, 0 if it is waited out on the host or None for the auto delay with adaptive settling
+    """
+    if settle_tolerance is not None:
+        return None
+    return 0.0 if settle_time > host_settle_threshold else settle_time
+
+
+def point_settings(settle_time: float = None):
+    """
+    Settings for setting and reading one point at a time. The voltage is usually set in the same message as the
+    :READ?, so the settle time is the source delay the instrument waits before measuring
+
+    :param settle_time: source delay before each reading (s), None for the instrument's auto delay, see
+                        source_delay()
+    :return: settings for apply_settings()
+    """
+    settings = {':SOUR:VOLT:MODE': 'FIX',  # Fixed source mode
+                ':TRIG:COUN': '1',  # One reading per :READ?
+                ':TRIG:DEL': '0'}
+    if settle_time is None:
+        settings[':SOUR:DEL:AUTO'] = 'ON'
+    else:
+        settings[':SOUR:DEL:AUTO'] = 'OFF'
+        settings[':SOUR:DEL'] = str(settle_time)
+    return settings
+
+
+async def fetch_readings(SrcMeter, command: str, data_format: str, elements: str):
+    """
+    Query readings and split the response by element. A response can hold any number of readings
+
+    Binary responses are decoded straight into NumPy arrays by pyvisa, ascii responses are converted in one go
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param command: query returning readings, :READ? or :TRAC:DATA?
+    :param data_format: format the Keithley was configured with: 'ascii', 'sreal' or 'dreal'
+    :param elements: :FORM:ELEM the Keithley was configured with
+    :return: NumPy array of each element, in the order of elements
+    """
+    num_elements = len(elements.split(','))
+
+    if data_format in binary_datatypes:
+        values = await transaction(SrcMeter, SrcMeter.query_binary_values, command,
+                                   datatype=binary_datatypes[data_format], is_big_endian=True, container=np.array)
+    else:
+        values = np.array((await query(SrcMeter, command)).split(','), dtype=float)
+
+    if len(values) < num_elements or len(values) % num_elements:
+        raise ValueError('Incomplete reading')
+    return [values[i::num_elements] for i in range(num_elements)]
+
+
+async def read_points(SrcMeter, data_format: str = 'ascii'):
+    """
+    Trigger a :READ? and split the response into voltages and currents
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param data_format: format the Keithley was configured with: 'ascii', 'sreal' or 'dreal'
+    :return: voltages (V) and currents (A) as NumPy arrays
+    """
+    readings = await fetch_readings(SrcMeter, ':READ?', data_format, reading_elements[data_format])
+    return readings[0], readings[1]
+
+
+def empty_points(size: int = 0):
+    """
+    Preallocate the arrays a sweep writes its readings into, so taking a point allocates nothing
+
+    :param size: most points the sweep can take
+    :return: point_columns name: NumPy array of size, filled in by the sweeps and cut down with trim_points()
+    """
+    return {name: np.empty(size) for name in point_columns}
+
+
+def trim_points(points: dict, count: int):
+    """
+    :param points: arrays from empty_points()
+    :param count: number of points taken
+    :return: point_columns name: view of the points taken
+    """
+    return {name: values[:count] for name, values in points.items()}
+
+
+async def settle(SrcMeter, set_time: float, max_wait: float, tolerance: float, data_format: str = 'ascii'):
+    """
+    Read back to back until two readings in a row agree, instead of waiting a fixed time for the cell to settle
+
+    Readings agree when they differ by no more than tolerance of the current plus settle_floor. If the cell is
+    still drifting after max_wait the next reading is kept anyway
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param set_time: clock() when the voltage was set
+    :param max_wait: longest time to wait for the cell to settle (s)
+    :param tolerance: allowed difference between readings as a fraction of the current
+    :param data_format: format the Keithley was configured with
+    :return: voltages (V) and currents (A) of the kept reading and when it was triggered after set_time (s)
+    """
+    previous = None
+    while True:
+        triggered = clock(SrcMeter) - set_time
+        result_volts, result_amps = await read_points(SrcMeter, data_format)
+        current = result_amps[0]
+
+        if previous is not None and abs(current - previous) <= tolerance * abs(current) + settle_floor:
+            return result_volts, result_amps, triggered
+        if triggered >= max_wait:
+            return result_volts, result_amps, triggered
+        previous = current
+
+
+async def read_point(SrcMeter, voltage: float, settle_time: float, data_format: str = 'ascii',
+                     settle_tolerance: float = None):
+    """
+    Set the voltage and read it once settled. A settle time up to host_settle_threshold is the source delay and the
+    voltage goes out with the :READ?, a longer one is waited out on the host so a cancel does not wait for it
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param voltage: voltage to source (V)
+    :param settle_time: delay between setting the voltage and measuring (s), the longest wait with settle_tolerance
+    :param data_format: format the Keithley was configured with
+    :param settle_tolerance: read until the current settles within this fraction, see settle()
+    :return: voltages (V) and currents (A) of the reading and the settle time (s)
+    """
+    command = ':SOUR:VOLT:LEV ' + str(voltage)
+    set_time = clock(SrcMeter)
+    if settle_tolerance is not None:
+        queue_command(SrcMeter, command)  # sent with the first :READ?
+        return await settle(SrcMeter, set_time, settle_time, settle_tolerance, data_format)
+
+    if settle_time <= host_settle_threshold:
+        queue_command(SrcMeter, command)  # sent with the :READ?
+    else:
+        await write(SrcMeter, command)
+        await pause(SrcMeter, settle_time - (clock(SrcMeter) - set_time))
+    result_volts, result_amps = await read_points(SrcMeter, data_format)
+    return result_volts, result_amps, settle_time
+
+
+def voc_stop(voltages, currents, margin: float):
+    """
+    Where a scan going up in voltage gets margin past its first zero current crossing (V_oc), to end the forward
+    scan there instead of at the stop voltage
+
+    :param voltages: voltages of the scan so far (V)
+    :param currents: currents of the scan so far (any unit)
+    :param margin: how far past V_oc to go (V)
+    :return: number of points up to and including the first one margin past V_oc, None if the scan is not there yet
+    """
+    if len(voltages) < 2 or voltages[-1] <= voltages[0] or not currents[0]:
+        return None
+    crossed = np.flatnonzero(np.sign(currents) != np.sign(currents[0]))
+    if not crossed.size:
+        return None
+
+    index = crossed[0]
+    v_oc = voltages[index - 1] + ((voltages[index] - voltages[index - 1]) * currents[index - 1] /
+                                  (currents[index - 1] - currents[index]))
+    past = np.flatnonzero(voltages[index:] >= v_oc + margin - 1e-6)
+    return int(index + past[0] + 1) if past.size else None
+
+
+def leg_finished(points: dict, voltage_points, voc_margin: float = None):
+    """
+    :param points: points a scan returned
+    :param voltage_points: voltages the scan was asked for (V)
+    :param voc_margin: margin past V_oc the scan could stop at, see voc_stop()
+    :return: True if the scan took every point or stopped past V_oc, False if it was cut short
+    """
+    count = len(points['voltages'])
+    if count == len(voltage_points):
+        return True
+    return voc_margin is not None and voc_stop(points['voltages'], points['currents'], voc_margin) == count
+
+
+async def point_by_point_sweep(SrcMeter, voltage_points, curr_limit: float, settle_time: float,
+                               data_format: str = 'ascii', settle_tolerance: float = None, on_points=None,
+                               voc_margin: float = None):
+    """
+    Set and then measure I and V for each point, see read_point()
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param voltage_points: voltages to source in order (V)
+    :param curr_limit: compliance current (A)
+    :param settle_time: delay between setting the voltage and measuring (s), the longest wait if settle_tolerance
+                        is given (the source delay is then the auto delay)
+    :param data_format: format the Keithley was configured with
+    :param settle_tolerance: read until the current settles within this fraction instead of waiting settle_time,
+                             see settle()
+    :param on_points: called with the voltages (V) and currents (mA) of new points as they are measured
+    :param voc_margin: stop a scan going up in voltage this far past V_oc (V), see voc_stop()
+    :return: point_columns name: NumPy array, voltages (V), currents (mA), settle times (s), compliances (mA) and
+             timestamps (s, host clock when each reading came back)
+    """
+    points = empty_points(len(voltage_points))
+    voltages, currents, settle_times, compliances, timestamps = (points[name] for name in point_columns)
+    count = 0
+    curr_limit = compliance_limit(SrcMeter, curr_limit)  # an earlier pass of the test may have raised it
+
+    while count < len(voltage_points):
+        voltage = voltage_points[count]
+        try:
+            result_volts, result_amps, settled = await read_point(SrcMeter, voltage, settle_time, data_format,
+                                                                  settle_tolerance)
+            read_time = clock(SrcMeter)
+            # check against current limit (in amps) with tolerance of 0.1mA
+            over_limit = abs(result_amps[0]) >= curr_limit - 1e-4
+            raised = await raise_compliance(SrcMeter, curr_limit, voltage) if over_limit else None
+        except asyncio.CancelledError:
+            print('Canceled', c=gui.WARNING)
+            break
+        except ValueError:
+            print('Unexpected Response', c=gui.ERROR)
+            break
+        except pyvisa.errors.VisaIOError as e:
+            communication_failure(SrcMeter, e)  # the points taken so far are kept
+            break
+
+        if raised:
+            curr_limit = raised
+            continue  # measure the point again
+
+        voltages[count] = result_volts[0]  # Volts
+        currents[count] = result_amps[0] * 1000  # Amps to milli-amps
+        settle_times[count] = settled  # seconds
+        compliances[count] = curr_limit * 1000  # Amps to milli-amps
+        timestamps[count] = read_time  # seconds
+        count += 1
+        if on_points:
+            on_points(voltages[count - 1:count], currents[count - 1:count])
+
+        if over_limit:
+            print('Current limit reached', c=gui.ERROR)
+            break
+        if voc_margin is not None and voc_stop(voltages[:count], currents[:count], voc_margin) == count:
+            print(f'Stopped {voc_margin:g}V past V_oc', c=gui.COMPLETE)
+            break
+
+    else:
+        print('Completed', c=gui.COMPLETE)
+
+    return trim_points(points, count)
+
+
+async def hardware_sweep(SrcMeter, voltage_points, hysteresis: bool, curr_limit: float, settle_time: float,
+                         data_format: str = 'ascii', on_points=None, point_time: float = 0.0, voc_margin: float = None):
+    """
+    Run the sweep on the Keithley's own sweep engine, set up with sweep_settings(). The source delay replaces the
+    PC settle delay and every point of a scan comes back from a single read. A hysteresis test runs the reverse
+    scan as a second sweep
+
+    To stop past V_oc the forward scan is run in voc_segments pieces, checked after each, and the reverse scan
+    starts from where it stopped
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param voltage_points: voltages of the first scan in order (V), must be evenly spaced
+    :param hysteresis: also run the scan in reverse
+    :param curr_limit: compliance current (A)
+    :param settle_time: source delay at each point (s)
+    :param data_format: format the Keithley was configured with
+    :param on_points: called with the voltages (V) and currents (mA) of each scan once it is read
+    :param point_time: shortest time each point takes (s), the host sleeps for the scan before asking for it
+    :param voc_margin: stop a scan going up in voltage this far past V_oc (V), see voc_stop()
+    :return: point_columns name: NumPy array, voltages (V), currents (mA), settle times (s, the source delay),
+             compliances (mA) and timestamps (s, spaced by the instrument's clock)
+    """
+    def sweep_scan(scan):
+        return ({':SOUR:VOLT:MODE': 'SWE', ':SOUR:VOLT:STAR': str(scan[0]), ':SOUR:VOLT:STOP': str(scan[-1]),
+                 ':TRIG:COUN': str(len(scan))}, scan)
+
+    if voc_margin is None:
+        scans = [voltage_points, np.flip(voltage_points)] if hysteresis else [voltage_points]
+        return await triggered_scans(SrcMeter, [sweep_scan(scan) for scan in scans], curr_limit, settle_time,
+                                     data_format, on_points, point_time)
+
+    segments = np.array_split(voltage_points, min(voc_segments, len(voltage_points)))
+    points = await triggered_scans(SrcMeter, [sweep_scan(segment) for segment in segments], curr_limit,
+                                   settle_time, data_format, on_points, point_time, voc_margin)
+    if hysteresis and leg_finished(points, voltage_points, voc_margin) and not is_canceled() and \
+            SrcMeter in applied_settings:  # not ended by a bus fault
+        turned = np.flip(voltage_points[:len(points['voltages'])])  # back from the turning point
+        reverse = await triggered_scans(SrcMeter, [sweep_scan(turned)], curr_limit, settle_time, data_format,
+                                        on_points, point_time)
+        points = {name: np.concatenate((points[name], reverse[name])) for name in points}
+    return points
+
+
+def list_chunks(voltage_points, chunk_size: int = list_size):
+    """
+    Split a voltage list into lists the Keithley's source memory can hold, see list_settings()
+
+    :param voltage_points: voltages in order (V)
+    :param chunk_size: most points in one list
+    :return: settings for apply_settings() and voltages of each chunk
+    """
+    chunks = []
+    for first in range(0, len(voltage_points), chunk_size):
+        chunk = voltage_points[first:first + chunk_size]
+        chunks.append(({':SOUR:VOLT:MODE': 'LIST', ':SOUR:LIST:VOLT': ','.join(f'{volt:.6g}' for volt in chunk),
+                        ':TRIG:COUN': str(len(chunk))}, chunk))  # One trigger per list point
+    return chunks
+
+
+async def list_sweep(SrcMeter, voltage_points, curr_limit: float, settle_time: float, data_format: str = 'ascii',
+                     on_points=None, point_time: float = 0.0):
+    """
+    Run any set of voltages on the Keithley's source list, set up with list_settings(). The list is uploaded and
+    swept like a scan of hardware_sweep(), lists longer than the Keithley holds are run as consecutive chunks and
+    their readings joined
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param voltage_points: voltages in order (V), any spacing or direction
+    :param curr_limit: compliance current (A)
+    :param settle_time: source delay at each point (s)
+    :param data_format: format the Keithley was configured with
+    :param on_points: called with the voltages (V) and currents (mA) of each chunk once it is read
+    :param point_time: shortest time each point takes (s), the host sleeps for the chunk before asking for it
+    :return: point_columns name: NumPy array, voltages (V), currents (mA), settle times (s, the source delay),
+             compliances (mA) and timestamps (s, spaced by the instrument's clock)
+    """
+    return await triggered_scans(SrcMeter, list_chunks(voltage_points), curr_limit, settle_time, data_format,
+                                 on_points, point_time)
+
+
+async def triggered_scans(SrcMeter, scans: list, curr_limit: float, settle_time: float, data_format: str = 'ascii',
+                          on_points=None, point_time: float = 0.0, voc_margin: float = None):
+    """
+    Run scans on the Keithley's trigger model one after another, each read back in a single transfer. Used by
+    hardware_sweep() and list_sweep()
+
+    Each scan is started with :INIT and the host sleeps while it runs, so a cancel returns straight away instead of
+    waiting for the scan to finish, the scan cut short is discarded and aborted by turn_output_off()
+
+    Reconnecting after a bus fault resets the instrument, ending the scan, so a fault retries the whole scan as set
+    by set_io_policy(): the settings are restored and the scan is triggered again
+
+    A scan that reaches the compliance current is cut at the first point at the limit. If the compliance can be
+    raised (see raise_compliance()) the rest of the scan, from that point on, runs again on the source list
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param scans: settings that set up each scan for apply_settings() and the voltages it sources (V)
+    :param curr_limit: compliance current (A)
+    :param settle_time: source delay at each point (s)
+    :param data_format: format the Keithley was configured with
+    :param on_points: called with the voltages (V) and currents (mA) of each scan once it is read
+    :param point_time: shortest time each point takes (s), the host sleeps for the scan before asking for it
+    :param voc_margin: stop once the points, going up in voltage, are this far past V_oc (V), see voc_stop()
+    :return: point_columns name: NumPy array, voltages (V), currents (mA), settle times (s, the source delay),
+             compliances (mA) and timestamps (s, spaced by the instrument's clock)
+    """
+    points = empty_points(sum(len(voltages) for _, voltages in scans))
+    count = 0
+    curr_limit = compliance_limit(SrcMeter, curr_limit)
+    scans = list(scans)
+    policy = io_policies.get(SrcMeter, default_io_policy)
+
+    while scans:
+        scan, voltages = scans.pop(0)
+        try:
+            for attempt in range(policy['retries'] + 1):
+                try:
+                    scanning.add(SrcMeter)
+                    if attempt:
+                        await reconnect(SrcMeter)
+                    await apply_settings(SrcMeter, scan)
+                    await write(SrcMeter, ':INIT')
+                    init_time = clock(SrcMeter)
+                    await pause(SrcMeter, len(voltages) * point_time)
+                    await query(SrcMeter, '*OPC?')  # the scan can run a little past the estimate
+                    readings = await fetch_readings(SrcMeter, ':FETC?', data_format, reading_elements[data_format])
+                    break
+                except pyvisa.errors.VisaIOError as e:
+                    await retry_pause(SrcMeter, e, attempt, policy['retries'], policy['backoff'])
+                finally:
+                    scanning.discard(SrcMeter)
+            result_volts, result_amps = readings[:2]
+            stamps = readings[reading_elements[data_format].split(',').index('TIME')]
+
+            # first point at the current limit (tolerance of 0.1mA)
+            over_limit = np.flatnonzero(np.abs(result_amps) >= curr_limit - 1e-4)[:1]
+            raised = await raise_compliance(SrcMeter, curr_limit, voltages[over_limit[0]]) if over_limit.size else None
+        except asyncio.CancelledError:
+            print('Canceled', c=gui.WARNING)
+            break
+        except ValueError:
+            print('Unexpected Response', c=gui.ERROR)
+            break
+        except pyvisa.errors.VisaIOError as e:
+            communication_failure(SrcMeter, e)  # the scans taken so far are kept
+            break
+
+        # spacing from the instrument's clock, started from when the scan was triggered
+        stamps = init_time + point_time + stamps - stamps[0]
+        if raised:
+            # keep the points before the limit, the rest is measured again at the new compliance
+            result_volts, result_amps, stamps = (values[:over_limit[0]] for values in (result_volts, result_amps,
+                                                                                      stamps))
+            scans[:0] = list_chunks(voltages[over_limit[0]:])
+        elif over_limit.size:
+            # keep the points up to and including the first one at the current limit
+            result_volts, result_amps, stamps = (values[:over_limit[0] + 1] for values in (result_volts, result_amps,
+                                                                                          stamps))
+
+        taken = slice(count, count + len(result_volts))
+        points['voltages'][taken] = result_volts  # Volts
+        np.multiply(result_amps, 1000, out=points['currents'][taken])  # Amps to milli-amps
+        points['settle_times'][taken] = settle_time  # seconds
+        points['compliances'][taken] = curr_limit * 1000  # Amps to milli-amps
+        points['timestamps'][taken] = stamps  # seconds
+        stop = voc_stop(points['voltages'][:taken.stop], points['currents'][:taken.stop], voc_margin) \
+            if voc_margin is not None else None
+        if stop:
+            taken = slice(taken.start, stop)  # the points past the stop are dropped
+        count = taken.stop
+        if on_points and count > taken.start:
+            on_points(points['voltages'][taken], points['currents'][taken])
+
+        if stop:
+            print(f'Stopped {voc_margin:g}V past V_oc', c=gui.COMPLETE)
+            break
+        if raised:
+            curr_limit = raised
+        elif over_limit.size:
+            print('Current limit reached', c=gui.ERROR)
+            break
+
+    else:
+        print('Completed', c=gui.COMPLETE)
+
+    return trim_points(points, count)
+
+
+def refine_points(voltages, currents, voltage_points, refine_width: float):
+    """
+    Pick the points of the full voltage grid around the features calculate_params depends on, found from a coarse
+    scan: 0V (J_sc and R_shunt), V_oc (R_series) and the maximum power point
+
+    :param voltages: coarse scan voltages (V)
+    :param currents: coarse scan currents (mA)
+    :param voltage_points: full voltage grid in scan order (V)
+    :param refine_width: distance either side of a feature to fill in (V)
+    :return: NumPy array of voltages from voltage_points, in scan order
+    """
+    order = np.argsort(voltages)
+    voltages = np.asarray(voltages)[order]
+    currents = np.asarray(currents)[order]
+
+    features = [0.0, voltages[np.argmin(voltages * currents)]]  # power is negative while the cell generates
+
+    crossings = np.flatnonzero(np.diff(np.sign(currents)) != 0)
+    if crossings.size:
+        i = crossings[0]
+        features.append(voltages[i] - currents[i] * (voltages[i + 1] - voltages[i]) / (currents[i + 1] - currents[i]))
+
+    distances = np.abs(np.subtract.outer(voltage_points, features))
+    return voltage_points[np.any(distances <= refine_width + 1e-9, axis=1)]
+
+
+async def adaptive_sweep(SrcMeter, voltage_points, hysteresis: bool, curr_limit: float, settle_time: float,
+                         data_format: str = 'ascii', coarse_factor: int = 5, refine_width: float = 0.03,
+                         settle_tolerance: float = None, on_points=None, voc_margin: float = None):
+    """
+    Scan every coarse_factor-th point first, then go back and fill in the full grid only around 0V, V_oc and the
+    maximum power point. The points of both passes are merged into one scan in scan order, a hysteresis test then
+    runs the reverse scan over the same points
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param voltage_points: full voltage grid in scan order (V)
+    :param hysteresis: also run the scan in reverse
+    :param curr_limit: compliance current (A)
+    :param settle_time: delay between setting the voltage and measuring (s)
+    :param data_format: format the Keithley was configured with
+    :param coarse_factor: coarse pass step as a multiple of the volt step
+    :param refine_width: distance either side of a feature to fill in (V)
+    :param settle_tolerance: settle each point by readings instead of a fixed delay, see point_by_point_sweep()
+    :param on_points: called with the voltages (V) and currents (mA) of new points as they are measured, the fine
+                      pass points arrive after the coarse pass
+    :param voc_margin: stop the coarse pass this far past V_oc (V) and only refine up to there, see voc_stop()
+    :return: point_columns name: NumPy array, voltages (V), currents (mA), settle times (s), compliances (mA) and
+             timestamps (s)
+    """
+    coarse_points = voltage_points[::coarse_factor]
+    if coarse_points[-1] != voltage_points[-1]:
+        coarse_points = np.append(coarse_points, voltage_points[-1])  # always reach the stop voltage
+
+    points = await point_by_point_sweep(SrcMeter, coarse_points, curr_limit, settle_time, data_format,
+                                        settle_tolerance, on_points, voc_margin)
+    if not leg_finished(points, coarse_points, voc_margin) or is_canceled():
+        return points  # cut short, nothing to refine
+    if len(points['voltages']) < len(coarse_points):
+        # stopped past V_oc, the grid ends at the turning point
+        coarse_points = coarse_points[:len(points['voltages'])]
+        voltage_points = voltage_points[:np.searchsorted(voltage_points, coarse_points[-1], side='right')]
+
+    fine_points = refine_points(points['voltages'], points['currents'], voltage_points, refine_width)
+    fine_points = fine_points[~np.isin(fine_points, coarse_points)]
+    if fine_points.size:
+        print(f'Refining around 0V, V_oc and V_mpp ({fine_points.size} points)', c=gui.IMPORTANT)
+        fine = await point_by_point_sweep(SrcMeter, fine_points, curr_limit, settle_time, data_format,
+                                          settle_tolerance, on_points)
+        if len(fine['voltages']) < len(fine_points) or is_canceled():
+            fine_points = fine_points[:len(fine['voltages'])]
+
+        # merge both passes into scan order
+        scan_points = np.concatenate((coarse_points, fine_points))
+        order = np.argsort(scan_points)
+        if voltage_points[-1] < voltage_points[0]:
+            order = np.flip(order)
+        scan_points = scan_points[order]
+        points = {name: np.concatenate((points[name], fine[name]))[order] for name in points}
+    else:
+        scan_points = coarse_points
+
+    if hysteresis and not is_canceled() and SrcMeter in applied_settings:  # not ended by a bus fault
+        reverse = await point_by_point_sweep(SrcMeter, np.flip(scan_points), curr_limit, settle_time, data_format,
+                                             settle_tolerance, on_points)
+        points = {name: np.concatenate((points[name], reverse[name])) for name in points}
+
+    return points
+
+
+async def run_iv(SrcMeter, profile, on_points=None):
+    """
+    returns voltage (V) and current (mA)
+
+    The profile's sweep_mode picks how the points are taken: 'point' sets and reads each point from the PC,
+    'sweep' hands the whole scan to the Keithley's sweep engine, 'adaptive' takes a coarse scan from the PC and
+    fills in the points around V_oc, V_mpp and 0V and 'list' uploads the voltages to the Keithley's source list, the
+    voltages in the first column of list_file if one is given. data_format picks how readings are transferred:
+    'ascii' text or 'sreal'/'dreal' binary floats. speed ('fast', 'normal' or 'precise') picks the integration time,
+    autozero and current ranging, see acquisition_options(). With settle_mode 'adaptive' the PC driven modes read each
+    point until it settles within settle_tolerance, with settle_time as the longest wait. With voc_margin a forward
+    sweep (start_volt below stop_volt) stops that far past V_oc and a hysteresis test turns back from there, except
+    in list mode where the list is swept as given. With compliance_step and
+    compliance_ceiling a point that reaches curr_limit raises the compliance and is measured again instead of ending
+    the sweep, the compliance of each point is returned with the data. Every point has a timestamp, seconds since
+    the sweep started, so each scan's own time and scan rate can be worked out, see calculate_timing()
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters
+    :param on_points: called with the voltages (V) and currents (mA) of new points while the test runs, from the
+                      thread running the test
+    :return: voltages, currents, time, volt rate and the other point_columns (name: values), the per point data
+             as NumPy arrays
+    """
+    if not SrcMeter or not profile:
+        return [], [], 0, 0, {}
+
+    start_volt = float(profile['start_volt'])
+    stop_volt = float(profile['stop_volt'])
+    volt_step = abs(float(profile['volt_step']))
+    curr_limit = abs(float(profile['curr_limit'])) / 1000  # mA to A
+    settle_time = abs(float(profile['settle_time']))
+    hysteresis = profile['hysteresis']
+    sweep_mode = profile.get('sweep_mode', 'point')
+    data_format = profile.get('data_format', 'ascii')
+    acquisition = acquisition_options(profile)
+    settle_tolerance = None
+    if profile.get('settle_mode', 'fixed') == 'adaptive':
+        settle_tolerance = abs(float(profile.get('settle_tolerance', 0.002)))
+    voc_margin = profile.get('voc_margin')
+    if voc_margin is not None and start_volt < stop_volt:
+        voc_margin = abs(float(voc_margin))
+    else:
+        voc_margin = None  # only a forward sweep gets past V_oc
+
+    if start_volt > stop_volt:
+        volt_step = -volt_step
+
+    volt_range = max(abs(start_volt), abs(stop_volt))
+    voltage_points = np.arange(start_volt, stop_volt+volt_step/2, volt_step)
+    if sweep_mode == 'list':
+        if profile.get('list_file'):
+            try:
+                voltage_points = load_voltage_list(profile['list_file'])
+            except (OSError, ValueError) as e:
+                print(f'Could not load the voltage list: {e}', c=gui.ERROR)
+                return [], [], 0, 0, {}
+        elif hysteresis:
+            voltage_points = np.concatenate((voltage_points, np.flip(voltage_points)))
+        volt_range = np.abs(voltage_points).max()
+
+    print("Running test...", c=gui.IMPORTANT)
+
+    points = empty_points()
+    elapsed = 0
+    volt_rate = 0
+    set_io_policy(SrcMeter, profile)
+    set_compliance_policy(SrcMeter, profile)
+
+    with cancellable(), io_timing(SrcMeter):
+        try:
+            set_phase(SrcMeter, 'configure')
+            # configure meter for voltage testing, only sending what changed since the last test
+            settings = source_settings(volt_range, curr_limit, data_format)
+            settings.update(acquisition_settings(acquisition))
+            if sweep_mode == 'sweep':
+                settings.update(sweep_settings(voltage_points, settle_time))
+            elif sweep_mode == 'list':
+                settings.update(list_settings(settle_time))
+            else:
+                settings.update(point_settings(source_delay(settle_time, settle_tolerance)))
+            await apply_settings(SrcMeter, settings)
+            queue_command(SrcMeter, ':SOUR:VOLT:LEV 0')  # start at 0V
+            await write(SrcMeter, ':OUTP ON')  # turn on output, all of the setup goes out in this write
+
+            # make sure the longest read outlasts its points: a whole scan or list chunk, or a single point
+            points_per_read = {'sweep': len(voltage_points), 'list': min(len(voltage_points), list_size)}.get(
+                sweep_mode, 1)
+            extend_timeout(SrcMeter, 2 * points_per_read * (settle_time + reading_time(acquisition)))
+
+            start = clock(SrcMeter)
+            set_phase(SrcMeter, 'sweep')
+
+            # the sweeps handle a cancellation themselves and return the points taken so far
+            if sweep_mode == 'sweep':
+                points = await hardware_sweep(SrcMeter, voltage_points, hysteresis, curr_limit, settle_time,
+                                              data_format, on_points,
+                                              settle_time + integration_time(acquisition, line_frequency=60.0),
+                                              voc_margin)
+            elif sweep_mode == 'list':
+                points = await list_sweep(SrcMeter, voltage_points, curr_limit, settle_time, data_format, on_points,
+                                          settle_time + integration_time(acquisition, line_frequency=60.0))
+            elif sweep_mode == 'adaptive':
+                points = await adaptive_sweep(SrcMeter, voltage_points, hysteresis, curr_limit, settle_time,
+                                              data_format, int(profile.get('coarse_factor', 5)),
+                                              float(profile.get('refine_width', 0.03)), settle_tolerance, on_points,
+                                              voc_margin)
+            else:
+                points = await point_by_point_sweep(SrcMeter, voltage_points, curr_limit, settle_time, data_format,
+                                                    settle_tolerance, on_points, voc_margin)
+                if hysteresis and leg_finished(points, voltage_points, voc_margin) and not is_canceled() and \
+                        SrcMeter in applied_settings:  # not ended by a bus fault
+                    turned = np.flip(voltage_points[:len(points['voltages'])])  # back from the turning point
+                    reverse = await point_by_point_sweep(SrcMeter, turned, curr_limit, settle_time, data_format,
+                                                         settle_tolerance, on_points)
+                    points = {name: np.concatenate((points[name], reverse[name])) for name in points}
+
+            elapsed = clock(SrcMeter) - start  # printing the outcome takes ~1ms
+            points['timestamps'] -= start  # seconds into the sweep
+
+            set_phase(SrcMeter, 'teardown')
+            if is_canceled() or SrcMeter not in applied_settings:
+                # canceled, or the sweep was ended by a bus fault
+                await turn_output_off(SrcMeter)  # also aborts an acquisition still running
+            else:
+                await write(SrcMeter, ":OUTP OFF")  # Turn off the source output
+
+            volt_range = np.abs(np.diff(points['voltages'])).sum()  # the distance actually swept
+            volt_rate = volt_range / elapsed
+
+        except asyncio.CancelledError:
+            # canceled while configuring, before any points were taken
+            print('Canceled', c=gui.WARNING)
+            await turn_output_off(SrcMeter)
+
+        except pyvisa.errors.VisaIOError as e:
+            communication_failure(SrcMeter, e)
+
+        set_phase(SrcMeter, None)
+
+    voltages = points.pop('voltages')
+    currents = points.pop('currents')
+    return voltages, currents, elapsed, volt_rate, points
+
+
+async def run_iv_batch(instruments: dict, profile):
+    """
+    Run the same IV test on several Keithleys at once on one event loop, so a batch takes about as long as its
+    slowest device
+
+    :param instruments: device name: pyvisa object for its Keithley
+    :param profile: test parameters
+    :return: device name: (voltages, currents, time, volt rate and other point columns)
+    """
+    results = await asyncio.gather(*[run_iv(SrcMeter, profile) for SrcMeter in instruments.values()])
+    return dict(zip(instruments, results))
+
+
+async def run_pixel_scan(SrcMeter, switch, pixels: dict, profile, on_points=None, on_pixel=None):
+    """
+    Run the IV test on each pixel of a substrate in turn, routing the Keithley to it through a switch system. The
+    output is off while the relays move and switch_settle seconds pass before the next test. The Keithley is only
+    configured for the first pixel, the others reuse its settings (see apply_settings()). on_pixel runs in this
+    thread: hand its results to another thread to calculate and save while the next pixel is measured
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param switch: pyvisa object for the switch, see connect_switch()
+    :param pixels: pixel name: channels to close for it, e.g. '1!1', '1!1,1!7' or a list of channels
+    :param profile: test parameters
+    :param on_points: called with the voltages (V) and currents (mA) of new points while each test runs
+    :param on_pixel: called after each pixel with its name, voltages, currents, time, volt rate and other point
+                     columns
+    :return: names of the pixels measured
+    """
+    switch_settle = abs(float(profile.get('switch_settle', 0.05)))
+    measured = []
+
+    with cancellable():
+        try:
+            for pixel, channels in pixels.items():
+                if is_canceled():
+                    break
+                if not isinstance(channels, str):
+                    channels = ','.join(channels)
+                print(f'{pixel} (channels {channels})', c=gui.IMPORTANT)
+                await call(switch.write, f':ROUT:OPEN:ALL;:ROUT:CLOS (@{channels})')
+                await asyncio.sleep(switch_settle)
+
+                results = await run_iv(SrcMeter, profile, on_points)
+                measured.append(pixel)
+                if on_pixel:
+                    on_pixel(pixel, *results)
+                if SrcMeter not in applied_settings:
+                    break  # the test was ended by a bus fault
+
+        except asyncio.CancelledError:
+            print('Canceled', c=gui.WARNING)
+
+        except pyvisa.errors.VisaIOError as e:
+            print('Switch Communication Failure', c=gui.ERROR)
+            print(e, c=gui.ERROR)
+
+        try:
+            await call(switch.write, ':ROUT:OPEN:ALL')  # leave every pixel disconnected
+        except pyvisa.errors.VisaIOError:
+            pass
+
+    return measured
+
+
+async def track_mpp(SrcMeter, profile, voltage: float, until: float, start: float, on_track=None):
+    """
+    Hold the cell at its maximum power point by perturb and observe: step the voltage by track_step, keep going
+    while the power rises and turn around when it falls. Each step is one transaction, the next voltage goes out
+    with the :READ? (two with a settle time over host_settle_threshold, see read_point())
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters, the voltage stays between start_volt and stop_volt
+    :param voltage: voltage to start from, V_mpp of the last sweep (V)
+    :param until: clock() to stop tracking at
+    :param start: clock() when the lifetime test started, time points are counted from it
+    :param on_track: called after each step with the time point (hours since start), voltage (V) and current (mA)
+    :return: the last voltage (V), or None if tracking was cut short
+    """
+    start_volt = float(profile['start_volt'])
+    stop_volt = float(profile['stop_volt'])
+    curr_limit = abs(float(profile['curr_limit'])) / 1000  # mA to A
+    settle_time = abs(float(profile['settle_time']))
+    data_format = profile.get('data_format', 'ascii')
+    step = abs(float(profile.get('track_step', 0.005)))
+
+    direction = 1
+    last_power = None
+
+    acquisition = acquisition_options(profile)
+
+    try:
+        settings = source_settings(max(abs(start_volt), abs(stop_volt)), curr_limit, data_format)
+        settings.update(acquisition_settings(acquisition))
+        settings.update(point_settings(source_delay(settle_time)))
+        await apply_settings(SrcMeter, settings)
+        queue_command(SrcMeter, ':SOUR:VOLT:LEV ' + str(voltage))
+        await write(SrcMeter, ':OUTP ON')
+        extend_timeout(SrcMeter, 2 * (settle_time + reading_time(acquisition)))
+
+        while clock(SrcMeter) < until and not is_canceled():
+            result_volts, result_amps, _ = await read_point(SrcMeter, voltage, settle_time, data_format)
+            if on_track:
+                on_track((clock(SrcMeter) - start) / 3600, float(result_volts[0]), float(result_amps[0]) * 1000)
+
+            power = -result_volts[0] * result_amps[0]  # positive while the cell generates
+            if last_power is not None and power < last_power:
+                direction = -direction
+            last_power = power
+
+            voltage = round(min(max(voltage + direction * step, min(start_volt, stop_volt)),
+                                max(start_volt, stop_volt)), 6)
+
+        await write(SrcMeter, ':OUTP OFF')
+
+    except asyncio.CancelledError:
+        print('Canceled', c=gui.WARNING)
+        await turn_output_off(SrcMeter)
+        return None
+
+    except ValueError:
+        print('Unexpected Response', c=gui.ERROR)
+        await turn_output_off(SrcMeter)
+        return None
+
+    except pyvisa.errors.VisaIOError as e:
+        communication_failure(SrcMeter, e)
+        return None
+
+    return voltage
+
+
+async def buffered_log(SrcMeter, profile, voltage: float, until: float, start: float, on_track=None):
+    """
+    Hold the cell at a fixed voltage and log it in the Keithley's trace buffer: the trigger model takes a reading
+    every log_interval (plus the reading time) with no host in the loop, the buffer is pulled back in one read
+    when it is full. The host only sleeps while the instrument logs
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters
+    :param voltage: voltage to hold, V_mpp of the last sweep (V)
+    :param until: clock() to stop logging at
+    :param start: clock() when the lifetime test started, time points are counted from it
+    :param on_track: called for each reading with the time point (hours since start), voltage (V) and current (mA)
+    :return: the voltage held (V), or None if logging was cut short
+    """
+    start_volt = float(profile['start_volt'])
+    stop_volt = float(profile['stop_volt'])
+    curr_limit = abs(float(profile['curr_limit'])) / 1000  # mA to A
+    data_format = profile.get('data_format', 'ascii')
+    interval = abs(float(profile.get('log_interval', 1.0)))
+    acquisition = acquisition_options(profile)
+    step_time = interval + integration_time(acquisition)
+
+    def report(init_time, readings):
+        volts, amps, stamps = readings
+        for reading_volts, reading_amps, stamp in zip(volts, amps, stamps):
+            # spacing from the instrument's clock, started from when the log was triggered
+            time_point = (init_time - start + step_time + stamp - stamps[0]) / 3600
+            if on_track:
+                on_track(time_point, float(reading_volts), float(reading_amps) * 1000)
+
+    init_time = clock(SrcMeter)
+    try:
+        settings = source_settings(max(abs(start_volt), abs(stop_volt)), curr_limit, data_format)
+        settings.update(acquisition_settings(acquisition))
+        await apply_settings(SrcMeter, settings)
+        queue_command(SrcMeter, ':SOUR:VOLT:LEV ' + str(voltage))
+        await write(SrcMeter, ':OUTP ON')
+
+        while not is_canceled():
+            remaining = until - clock(SrcMeter)
+            if remaining <= step_time:
+                break
+            count = int(min(buffer_size, remaining // step_time))
+            queue_command(SrcMeter, ':TRAC:FEED:CONT NEV')  # the buffer size can only change while it is idle
+            await apply_settings(SrcMeter, log_settings(count, interval))
+            queue_command(SrcMeter, ':TRAC:CLE')  # empty the buffer
+            queue_command(SrcMeter, ':TRAC:FEED:CONT NEXT')  # fill it with the next count readings
+            init_time = clock(SrcMeter)
+            await write(SrcMeter, ':INIT')
+
+            await pause(SrcMeter, count * step_time)
+            extend_timeout(SrcMeter, count * (step_time + 0.05))
+            await query(SrcMeter, '*OPC?')  # the log can run a little past the estimate
+            report(init_time, await fetch_readings(SrcMeter, ':TRAC:DATA?', data_format, log_elements))
+
+        await write(SrcMeter, ':OUTP OFF')
+
+    except asyncio.CancelledError:
+        print('Canceled', c=gui.WARNING)
+        try:
+            await write(SrcMeter, ':ABOR')  # stop the log, the readings stored so far are kept
+            report(init_time, await fetch_readings(SrcMeter, ':TRAC:DATA?', data_format, log_elements))
+        except (ValueError, pyvisa.errors.VisaIOError):
+            pass  # nothing stored yet
+        await turn_output_off(SrcMeter)
+        return None
+
+    except ValueError:
+        print('Unexpected Response', c=gui.ERROR)
+        await turn_output_off(SrcMeter)
+        return None
+
+    except pyvisa.errors.VisaIOError as e:
+        communication_failure(SrcMeter, e)
+        return None
+
+    return voltage
+
+
+async def capture_spo(SrcMeter, profile, voltage: float):
+    """
+    Stabilized power output: hold the cell at a voltage for spo_time seconds and sample it spo_rate times a second
+    in the Keithley's trace buffer, see buffered_log(). The rate is limited by the reading time
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters
+    :param voltage: voltage to hold, V_mpp of the sweep (V)
+    :return: times (s since the hold started), voltages (V) and currents (mA) of the readings as NumPy arrays
+    """
+    spo_time = abs(float(profile.get('spo_time', 0.0)))
+    spo_rate = abs(float(profile.get('spo_rate', 20.0)))
+    interval = max(0.0, 1 / spo_rate - integration_time(acquisition_options(profile)))
+
+    readings = []
+    print(f'Holding {voltage:g}V for {spo_time:g}s', c=gui.IMPORTANT)
+    start = clock(SrcMeter)
+    await buffered_log(SrcMeter, dict(profile, log_interval=interval), voltage, start + spo_time, start,
+                       lambda time_point, volts, amps: readings.append((time_point * 3600, volts, amps)))
+
+    times, voltages, currents = np.array(readings, dtype=float).reshape(-1, 3).T
+    return times, voltages, currents
+
+
+async def run_iv_spo(SrcMeter, profile, on_points=None, pick_voltage=None):
+    """
+    Run the IV test, then capture the stabilized power output at the voltage pick_voltage() chooses from its data,
+    see capture_spo(). Both run as one test, so a cancel ends either and a sweep cut short is not followed by a hold
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters
+    :param on_points: called with the voltages (V) and currents (mA) of new points while the IV test runs
+    :param pick_voltage: called with the voltages (V) and currents (mA) of the IV test, returns the voltage to hold
+                         (V_mpp) or None to skip the hold
+    :return: results of run_iv() and the times (s), voltages (V) and currents (mA) of the hold
+    """
+    spo = np.empty(0), np.empty(0), np.empty(0)
+    with cancellable(), io_timing(SrcMeter):
+        results = await run_iv(SrcMeter, profile, on_points)
+        if len(results[0]) and not is_canceled() and SrcMeter in applied_settings:
+            voltage = pick_voltage(results[0], results[1]) if pick_voltage else None
+            if voltage is not None:
+                set_phase(SrcMeter, 'hold')
+                spo = await capture_spo(SrcMeter, profile, voltage)
+                set_phase(SrcMeter, None)
+    return results, spo
+
+
+async def run_lifetime(SrcMeter, profile, duration: float, on_sweep=None, on_track=None):
+    """
+    Run IV tests back to back for a duration, or until canceled
+
+    With mpp_tracking in the profile the cell is held at its maximum power point between tests instead and a full
+    IV test only runs every sweep_interval seconds. hold_mode picks how: 'track' follows the maximum power point
+    from the host, see track_mpp(), 'log' holds V_mpp of the last test and logs in the trace buffer, see
+    buffered_log()
+
+    The bus timing of the whole lifetime test is reported once at its end, see io_timing()
+
+    A test ended by a bus fault that outlasted its retries (see set_io_policy()) is started over after
+    retry_backoff seconds, doubling for each failed test in a row, until retries tests in a row have failed. A
+    replay that no longer matches its recording is not started over
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters
+    :param duration: hours
+    :param on_sweep: called after each test with the time point (hours since start), voltages, currents, time,
+                     volt rate and other point columns of the test
+    :param on_track: called for each reading between tests, see track_mpp()
+    :return: time point of each test
+    """
+    time_points = []
+    start = clock(SrcMeter)
+    end = start + duration * 3600
+    tracking = profile.get('mpp_tracking', False)
+    sweep_interval = abs(float(profile.get('sweep_interval', 600)))
+    hold = buffered_log if profile.get('hold_mode', 'track') == 'log' else track_mpp
+
+    failures = 0  # tests in a row ended by a bus fault
+    retries = abs(int(profile.get('retries', 3)))
+    backoff = abs(float(profile.get('retry_backoff', 1.0)))
+
+    with cancellable(), io_timing(SrcMeter):
+        while clock(SrcMeter) <= end and not is_canceled():
+            voltages, currents, elapsed, volt_rate, columns = await run_iv(SrcMeter, profile)
+            if SrcMeter not in applied_settings and not is_canceled():
+                # a bus fault outlasted the retries of a transaction, wait and start over with a new test
+                if isinstance(SrcMeter, recorder.ReplayKeithley) and SrcMeter.diverged:
+                    print('Lifetime test stopped, the replay no longer matches the recording', c=gui.ERROR)
+                    break
+                failures += 1
+                if failures > retries:
+                    print('Lifetime test stopped after repeated communication failures', c=gui.ERROR)
+                    break
+                delay = backoff * 2 ** (failures - 1)
+                print(f'Restarting the lifetime test in {delay:g}s', c=gui.WARNING)
+                try:
+                    await pause(SrcMeter, delay)
+                except asyncio.CancelledError:
+                    break
+            else:
+                failures = 0
+            if not len(voltages):
+                continue  # canceled or failed before any points were taken
+
+            time_point = (clock(SrcMeter) - start) / 3600
+            time_points.append(time_point)
+            if on_sweep:
+                on_sweep(time_point, voltages, currents, elapsed, volt_rate, columns)
+
+            if tracking and not is_canceled():
+                v_mpp = voltages[int(np.argmin(np.multiply(voltages, currents)))]
+                set_phase(SrcMeter, 'hold')
+                await hold(SrcMeter, profile, v_mpp, min(clock(SrcMeter) + sweep_interval, end), start, on_track)
+
+    return time_points
+
+
+# synchronous wrappers, each runs its test on a new event loop in the calling thread
+
+def run_IV_test(SrcMeter, profile, on_points=None):
+    """
+    returns voltage (V) and current (mA), see run_iv()
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters
+    :param on_points: called with the voltages (V) and currents (mA) of new points while the test runs
+    :return: voltages, currents, time, volt rate and other point columns
+    """
+    with recording(SrcMeter, profile, 'iv'):
+        return asyncio.run(run_iv(SrcMeter, profile, on_points))
+
+
+def run_IV_SPO_test(SrcMeter, profile, on_points=None, pick_voltage=None):
+    """
+    Run the IV test followed by a stabilized power output hold, see run_iv_spo()
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters
+    :param on_points: called with the voltages (V) and currents (mA) of new points while the IV test runs
+    :param pick_voltage: called with the voltages (V) and currents (mA) of the IV test, returns the voltage to hold
+    :return: voltages, currents, time, volt rate and other point columns of the IV test and the times (s),
+             voltages (V) and currents (mA) of the hold
+    """
+    with recording(SrcMeter, profile, 'spo'):
+        return asyncio.run(run_iv_spo(SrcMeter, profile, on_points, pick_voltage))
+
+
+def run_IV_batch(instruments: dict, profile):
+    """
+    Run the same IV test on several Keithleys at once, see run_iv_batch()
+
+    :param instruments: device name: pyvisa object for its Keithley
+    :param profile: test parameters
+    :return: device name: (voltages, currents, time, volt rate and other point columns)
+    """
+    if not instruments:
+        return {}
+    return asyncio.run(run_iv_batch(instruments, profile))
+
+
+def run_pixel_test(SrcMeter, switch, pixels: dict, profile, on_points=None, on_pixel=None):
+    """
+    Run the IV test on each pixel of a substrate in turn through a switch system, see run_pixel_scan()
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param switch: pyvisa object for the switch
+    :param pixels: pixel name: channels to close for it
+    :param profile: test parameters
+    :param on_points: called with the voltages (V) and currents (mA) of new points while each test runs
+    :param on_pixel: called after each pixel with its name, voltages, currents, time, volt rate and other point
+                     columns
+    :return: names of the pixels measured
+    """
+    with recording(SrcMeter, profile, 'pixels'):
+        return asyncio.run(run_pixel_scan(SrcMeter, switch, pixels, profile, on_points, on_pixel))
+
+
+def run_lifespan_test(SrcMeter, profile, duration: float, on_sweep=None, on_track=None):
+    """
+    Run IV tests back to back for a duration, or track the maximum power point between them, see run_lifetime()
+
+    :param SrcMeter: pyvisa object for Keithley
+    :param profile: test parameters
+    :param duration: hours
+    :param on_sweep: called after each test with the time point (hours since start), voltages, currents, time,
+                     volt rate and other point columns of the test
+    :param on_track: called for each reading between tests with the time point, voltage (V) and current (mA)
+    :return: time point of each test
+    """
+    with recording(SrcMeter, profile, 'lifetime'):
+        return asyncio.run(run_lifetime(SrcMeter, profile, duration, on_sweep, on_track))
@@ -20,11 +20,13 @@ updated by : Yajing Song
 import os
 from datetime import datetime
 
+import numpy as np
 import PySimpleGUI
 from configobj import ConfigObj
-from pandas import read_csv, DataFrame, concat, to_numeric
+from pandas import read_csv, DataFrame, Series, concat, to_numeric
 from validate import Validator
 import source_meter_gui as gui
+from presets import acquisition_options
 from contextlib import contextmanager
 
 # reroute print statements to the Alerts Multiline element in the gui
@@ -32,6 +34,23 @@ print = gui.alert
 
 file_op_errors = False  # flag for most recent file operation
 
+# profile settings without a gui element - edited in the profile file, defaults come from the spec file
+advanced_keys = ['sweep_mode', 'list_file', 'coarse_factor', 'refine_width', 'settle_mode', 'settle_tolerance',
+                 'sweep_interval', 'hold_mode', 'track_step', 'log_interval', 'speed', 'nplc', 'autozero',
+                 'curr_range', 'data_format', 'resource_name', 'baud_rate', 'query_timeout', 'retries',
+                 'retry_backoff', 'record_dir', 'switch_resource', 'switch_settle', 'spo_time', 'spo_rate',
+                 'compliance_step', 'compliance_ceiling', 'voc_margin', 'instruments', 'pixels']
+
+# header of each per point column in the data files, columns after the first three are optional
+data_headers = {'voltages': 'Voltage (V)', 'currents': 'Current (mA)', 'current_densities': 'Current Density (mA/cm2)',
+                'settle_times': 'Settle Time (s)', 'compliances': 'Compliance (mA)',
+                'timestamps': 'Time (s)'}
+
+# profile settings saved with the results, in the same order as the results file headers
+# speed, nplc, autozero and curr_range are the acquisition settings the test ran with, see acquisition_options()
+results_profile_keys = ['area', 'curr_limit', 'start_volt', 'stop_volt', 'volt_step', 'settle_time', 'illum', 'speed',
+                        'nplc', 'autozero', 'curr_range']
+
 
 def get_file_paths(user_directory: str, device_name: str, experiment_name: str) -> (str, str):
     """
@@ -64,10 +83,11 @@ def get_file_paths(user_directory: str, device_name: str, experiment_name: str)
 
 
 def sort_data(voltages_1: list, voltages_2: list, currents_1: list, currents_2: list, current_densities_1: list,
-              current_densities_2: list) -> dict:
+              current_densities_2: list, columns_1: dict = None, columns_2: dict = None) -> dict:
     """
     Analyze the file/keithley data so forward/reverse scans are sorted properly
-    If there are two scans (same col or not) they are assumed to have the same number of data points
+    Two scans in the same col are split where the voltage turns back, so they can have different numbers of points
+    (a forward scan stopped past V_oc turns back early)
 
     data format options:
     col1: forward
@@ -83,8 +103,16 @@ def sort_data(voltages_1: list, voltages_2: list, currents_1: list, currents_2:
     :param currents_2: second col of currents
     :param current_densities_1: first col of current densities
     :param current_densities_2: second col of current densities
+    :param columns_1: other per point data of the first col, name: values (e.g. settle_times)
+    :param columns_2: other per point data of the second col
     :return: a data dictionary where forward and reverse scans are properly sorted
     """
+    # the source meter returns NumPy arrays, the data dictionary holds lists
+    voltages_1, voltages_2, currents_1, currents_2, current_densities_1, current_densities_2 = (
+        np.asarray(values, dtype=float).tolist() for values in (voltages_1, voltages_2, currents_1, currents_2,
+                                                               current_densities_1, current_densities_2))
+    columns_1 = {name: np.asarray(values, dtype=float).tolist() for name, values in (columns_1 or {}).items()}
+    columns_2 = {name: np.asarray(values, dtype=float).tolist() for name, values in (columns_2 or {}).items()}
 
     is_two_cols = bool(voltages_2)
     if len(voltages_1) < 2:
@@ -93,6 +121,10 @@ def sort_data(voltages_1: list, voltages_2: list, currents_1: list, currents_2:
     else:
         col1_is_forward = (voltages_1[1] > voltages_1[0])  # increasing slope at start
         col1_is_two_scans = (col1_is_forward != (voltages_1[-1] > voltages_1[-2]))  # start slope != end slope
+    # first point after the turn, a turning point measured twice goes once to each scan
+    steps = np.diff(voltages_1)
+    turned = np.flatnonzero(steps <= 0 if col1_is_forward else steps >= 0) if col1_is_two_scans else []
+    mid = int(turned[0]) + 1 if len(turned) else int(len(voltages_1) / 2)
 
     data = {}
 
@@ -112,7 +144,6 @@ def sort_data(voltages_1: list, voltages_2: list, currents_1: list, currents_2:
             data['currents_reverse'] = currents_1
             data['current_densities_reverse'] = current_densities_1
     elif col1_is_two_scans:
-        mid = int(len(voltages_1) / 2)
         if col1_is_forward:
             data['voltages_forward'] = voltages_1[:mid]
             data['currents_forward'] = currents_1[:mid]
@@ -143,6 +174,17 @@ def sort_data(voltages_1: list, voltages_2: list, currents_1: list, currents_2:
             data['currents_reverse'] = currents_1
             data['current_densities_reverse'] = current_densities_1
 
+    # other per point data is split the same way
+    for name in dict.fromkeys([*columns_1, *columns_2]):
+        values_1 = columns_1.get(name, [])
+        if is_two_cols:
+            first, second = values_1, columns_2.get(name, [])
+        elif col1_is_two_scans:
+            first, second = values_1[:mid], values_1[mid:]
+        else:
+            first, second = values_1, []
+        data[name + '_forward'], data[name + '_reverse'] = (first, second) if col1_is_forward else (second, first)
+
     return data
 
 
@@ -206,6 +248,7 @@ def read_profile(file_path: str, spec_file: str):
                  'illum': config["illum"],
                  'hysteresis': config["hysteresis"],
                  'curr_density': config["curr_density"]}
+        param.update({key: config[key] for key in advanced_keys if key in config})
     except KeyError as e:
         print(f'Missing value in {os.path.basename(file_path)}: {e}', c=gui.ERROR)
         param = None
@@ -239,6 +282,7 @@ def read_profile2(file_path: str, spec_file: str):
                  'illum': config["illum"],
                  'hysteresis': config["hysteresis"],
                  'curr_density': config["curr_density"]}
+        param.update({key: config[key] for key in advanced_keys if key in config})
     except KeyError as e:
         print(f'Missing value in {os.path.basename(file_path)}: {e}', c=gui.ERROR)
         param = None
@@ -264,6 +308,7 @@ def load_profile(file_path: str, spec_file: str, window: PySimpleGUI.Window):
     window['-ILLUM-'].update(profile['illum'])
     window['-HYSTERESIS-'].update(profile['hysteresis'])
     window['-CURR-DENSITY-'].update(profile['curr_density'])
+    gui.advanced_profile = {key: profile[key] for key in advanced_keys if key in profile}
 
     print('Loaded profile from ' + os.path.basename(file_path))
 
@@ -312,6 +357,9 @@ def save_profile(file_path: str, spec_file: str, param: dict):
     config["illum"] = param['illum']
     config["hysteresis"] = param['hysteresis']
     config["curr_density"] = param['curr_density']
+    for key in advanced_keys:
+        if param.get(key) is not None:  # unset options are left out, the spec can't validate None
+            config[key] = param[key]
 
     if os.path.exists(spec_file): # if the path exists, return true
         if not config.validate(Validator()):
@@ -338,15 +386,16 @@ def load_data(file_path: str):
     if file_op_errors:
         return None
 
-    if not file_data.apply(lambda s: to_numeric(s, errors='coerce').notnull().all()).all():
+    # blank cells pad the end of the shorter scan
+    if not file_data.apply(lambda s: (to_numeric(s, errors='coerce').notnull() | s.isnull()).all()).all():
         print('Non numeric data detected', c=gui.ERROR)
         print('Did you try to load an Oscilla file?', c=gui.ERROR)
         return None
 
     try:
-        voltages_1 = file_data['Voltage (V)'].to_list()
-        currents_1 = file_data['Current (mA)'].to_list()
-        current_densities_1 = file_data['Current Density (mA/cm2)'].to_list()
+        voltages_1 = file_data['Voltage (V)'].dropna().to_list()
+        currents_1 = file_data['Current (mA)'].dropna().to_list()
+        current_densities_1 = file_data['Current Density (mA/cm2)'].dropna().to_list()
     except KeyError as e:
         print(f'Could not find column {e} in {os.path.basename(file_path)}', c=gui.ERROR)
         print('Check column naming and try again', c=gui.ERROR)
@@ -362,15 +411,22 @@ def load_data(file_path: str):
 
     try:
         # pandas appends '.1' when it detects duplicate column names
-        voltages_2 = file_data['Voltage (V).1'].to_list()
-        currents_2 = file_data['Current (mA).1'].to_list()
-        current_densities_2 = file_data['Current Density (mA/cm2).1'].to_list()
+        voltages_2 = file_data['Voltage (V).1'].dropna().to_list()
+        currents_2 = file_data['Current (mA).1'].dropna().to_list()
+        current_densities_2 = file_data['Current Density (mA/cm2).1'].dropna().to_list()
     except KeyError:
         # this file contained only one column set, not a problem
         # todo: or the second set of columns had a naming error
         voltages_2 = currents_2 = current_densities_2 = []
 
-    data = sort_data(voltages_1, voltages_2, currents_1, currents_2, current_densities_1, current_densities_2)
+    # optional columns, e.g. settle times, older files do not have them
+    columns_1 = {name: file_data[header].dropna().to_list() for name, header in list(data_headers.items())[3:]
+                 if header in file_data}
+    columns_2 = {name: file_data[header + '.1'].dropna().to_list() for name, header in list(data_headers.items())[3:]
+                 if header + '.1' in file_data}
+
+    data = sort_data(voltages_1, voltages_2, currents_1, currents_2, current_densities_1, current_densities_2,
+                     columns_1, columns_2)
 
     print('Loaded data from ' + os.path.basename(file_path))
     return data
@@ -390,22 +446,19 @@ def save_data(file_path: str, data: dict):
     if file_op_errors:
         return
 
-    headers = ['Voltage (V)', 'Current (mA)', 'Current Density (mA/cm2)']
-
-    # only write data for scans that took place
-    if data['voltages_forward'] and data['voltages_reverse']:
-        write_data = dict(data)
-        headers += headers
-    elif not data['voltages_forward']:
-        write_data = {'voltages_reverse': data['voltages_reverse'],
-                      'currents_reverse': data['currents_reverse'],
-                      'current_densities_reverse': data['current_densities_reverse']}
-    else:
-        write_data = {'voltages_forward': data['voltages_forward'],
-                      'currents_forward': data['currents_forward'],
-                      'current_densities_forward': data['current_densities_forward']}
+    # only write data for scans that took place, and the optional columns the scans have
+    write_data = {}
+    headers = []
+    for scan in ('forward', 'reverse'):
+        if not data['voltages_' + scan]:
+            continue
+        for name, header in data_headers.items():
+            if data.get(name + '_' + scan):
+                write_data[name + '_' + scan] = data[name + '_' + scan]
+                headers.append(header)
 
-    df = DataFrame(data=write_data)
+    # scans can have different numbers of points, the shorter columns are padded with blank cells
+    df = DataFrame(data={name: Series(values, dtype=float) for name, values in write_data.items()})
 
     with safe_file_operation(file_path):
         df.to_csv(file_path, index=False, header=headers)
@@ -415,6 +468,44 @@ def save_data(file_path: str, data: dict):
     print('Saved data to ' + os.path.basename(file_path), c=gui.COMPLETE)
 
 
+def io_report_path(data_path: str) -> str:
+    """
+    Path of the bus timing report saved next to a data file, '... data.csv' becomes '... io.csv'
+
+    :param data_path: Path of the data file
+    :return: report path
+    """
+    base, ext = os.path.splitext(data_path)
+    if base.endswith(' data'):
+        base = base[:-len(' data')]
+    return base + ' io' + ext
+
+
+def save_io_report(file_path: str, rows: list):
+    """
+    Save the bus timing report of a test, rows from communication.io_report()
+
+    :param file_path: Path of the report file
+    :param rows: report rows as dicts of column: value
+    :return: nothing
+    """
+    if not file_path or not rows:
+        return
+
+    dir_name = os.path.dirname(file_path)
+    with safe_file_operation(dir_name):
+        os.makedirs(dir_name, exist_ok=True)
+    if file_op_errors:
+        return
+
+    with safe_file_operation(file_path):
+        DataFrame(rows).to_csv(file_path, index=False)
+    if file_op_errors:
+        return
+
+    print('Saved bus timing to ' + os.path.basename(file_path), c=gui.COMPLETE)
+
+
 def save_results(file_path: str, experiment_name: str, results_forward: dict, results_reverse: dict, profile: dict):
     if not file_path or not experiment_name:
         return
@@ -437,14 +528,32 @@ def save_results(file_path: str, experiment_name: str, results_forward: dict, re
 
     headers = ['Date', 'Time', 'Experiment Name', 'Scan Direction', 'J_sc (mA/cm2)', 'V_oc (V)', 'R_shunt (Ohm)',
                'R_series (Ohm)', 'Max Power (mW/cm2)', 'V_mpp (V)', 'I_mpp (mA)', 'PCE (%)', 'FF (%)', 'Sweep Time (s)',
-               'Volt Rate (V/s)', 'Device Area (cm2)', 'Current Limit (mA)', 'Start Volt (V)', 'Stop Volt (V)',
-               'Volt Step (V)', 'Settle Time (s)', 'Illumination (mW/cm2)']
+               'Volt Rate (V/s)', 'SPO PCE (%)', 'Device Area (cm2)', 'Current Limit (mA)', 'Start Volt (V)',
+               'Stop Volt (V)', 'Volt Step (V)', 'Settle Time (s)', 'Illumination (mW/cm2)', 'Speed Preset', 'NPLC',
+               'Autozero', 'Current Range (mA)']
+
+    # a file written with other columns (by an older version) is rewritten under these headers, its rows are kept
+    # with the columns they did not have left blank. A file with columns not known here is left alone and the
+    # results go to a new file next to it
+    columns = None  # of the file the results are added to
+    base, ext = os.path.splitext(file_path)
+    copy = 1
+    while os.path.exists(file_path):
+        with safe_file_operation(file_path):
+            with open(file_path) as file:
+                empty = not file.read(1)
+            columns = None if empty else list(read_csv(file_path, nrows=0).columns)
+        if file_op_errors:
+            return
+        if columns is None or set(columns) <= set(headers):
+            break
+        copy += 1
+        file_path = f'{base} ({copy}){ext}'
+        print(f'Results file has unknown columns, saving to {os.path.basename(file_path)}', c=gui.WARNING)
+        columns = None
 
-    # check if file already has headers
-    if os.path.exists(file_path):
-        with safe_file_operation(file_path), open(file_path) as file:
-            if file.read(1):
-                headers = False
+    # record the acquisition settings the preset and overrides resolve to
+    profile = dict(profile, **acquisition_options(profile))
 
     # confirm for/rev scans get proper start/stop volt
     profile_opp = dict(profile)
@@ -461,17 +570,23 @@ def save_results(file_path: str, experiment_name: str, results_forward: dict, re
 
     if results_forward and results_forward['J_sc'] != 0:
         results_df = DataFrame([date, time, experiment_name, 'forward'] + list(results_forward.values())).transpose()
-        profile_df = DataFrame(list(profile_forward.values())[0:-2]).transpose()
+        profile_df = DataFrame([profile_forward[key] for key in results_profile_keys]).transpose()
         forward_df = concat([results_df, profile_df], axis=1)
         df = concat([df, forward_df])
     if results_reverse and results_reverse['J_sc'] != 0:
         results_df = DataFrame([date, time, experiment_name, 'reverse'] + list(results_reverse.values())).transpose()
-        profile_df = DataFrame(list(profile_reverse.values())[0:-2]).transpose()
+        profile_df = DataFrame([profile_reverse[key] for key in results_profile_keys]).transpose()
         reverse_df = concat([results_df, profile_df], axis=1)
         df = concat([df, reverse_df])
+    df.columns = headers
 
     with safe_file_operation(file_path):
-        df.to_csv(file_path, index=False, header=headers, mode='a')
+        if columns is None:
+            df.to_csv(file_path, index=False)
+        elif columns == headers:
+            df.to_csv(file_path, index=False, header=False, mode='a')
+        else:
+            concat([read_csv(file_path).reindex(columns=headers), df]).to_csv(file_path, index=False)
     if file_op_errors:
         return
 
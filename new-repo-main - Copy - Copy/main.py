@@ -1,4 +1,5 @@
 
+from functools import partial
 from os import path
 import re
 import sys
@@ -13,7 +14,7 @@ import plotter
 import source_meter_gui as gui
 import file_io as f
 from plotter import plot_data
-from calculations import calculate_params
+from calculations import calculate_params, calculate_spo, calculate_timing
 import communication as comm
 from sub_plots import plot_subplots
 
@@ -61,26 +62,64 @@ volt_rate2 = 0.0
 # most recent calculated values
 results_forward = {}
 results_reverse = {}
+# stabilized power output PCE (%) of the most recent test, None if it had no hold at V_mpp
+spo_pce = None
 # to store most recent calculated values
 results2_forward = {}
 results2_reverse = {}
 
 
+# most recent multi-instrument batch, device name: (data, sweep time, volt rate, bus timing rows)
+batch_runs = {}
+# bus timing of the most recent test, see comm.io_report()
+io_rows = None
+
 # thread handling Keithley communication
 measure_thread = None
 #The None keyword is used to define a null value, or no value at all. None is not the same as 0, False, or an empty string. None is a data type of its own (NoneType) and only None can be None.
 
 
-def update_output():
+def connect_instrument():
+    """
+    Connect to the instrument named in the loaded profile and check it responds. Sessions are reused between tests
+
+    :return: Keithley as pyvisa object, None if it could not be reached
+    """
+    instrument = comm.connect_to_instrument(gui.advanced_profile.get('resource_name'),
+                                            gui.advanced_profile.get('baud_rate', 9600))
+    if not comm.test_communication(instrument):
+        return None
+    return instrument
+
+
+def connect_instruments(instruments: dict):
+    """
+    Connect to every instrument of a multi-instrument profile. Instruments that can't be reached are left out
+
+    :param instruments: device name: VISA resource name
+    :return: device name: Keithley as pyvisa object
+    """
+    connected = {}
+    for device_name, resource in instruments.items():
+        print(f'{device_name} ({resource})', c=gui.IMPORTANT)
+        instrument = comm.connect_to_instrument(resource, gui.advanced_profile.get('baud_rate', 9600))
+        if comm.test_communication(instrument):
+            connected[device_name] = instrument
+    return connected
+
+
+def update_output(current_values: dict = None):
     """
     Update the plot and recalculate and update the results.
 
+    :param current_values: values of the window from the event loop, read from the window if not given. Pass them
+                           while a test thread is posting events, window.read() would take its next event off the queue
     :return: nothing
     """
     global results_forward, results_reverse, values
     # these two variables can be use out of local function
 
-    values = window.read(0)[1]
+    values = window.read(0)[1] if current_values is None else current_values
     plot_data(window, data, show_density=values['-CURR-DENSITY-'])
 
     try:
@@ -89,16 +128,17 @@ def update_output():
         results_reverse = calculate_params(data['voltages_reverse'], data['currents_reverse'],
                                            float(values['-AREA-']), float(values['-ILLUM-']))
 
-        # todo: clean this up, put in sort_data or calculate_params?
-        if results_forward and results_reverse:
-            results_forward['sweep_time'] = results_reverse['sweep_time'] = (sweep_time / 2)
-            results_forward['volt_rate'] = results_reverse['volt_rate'] = volt_rate
-        elif results_forward:
-            results_forward['sweep_time'] = sweep_time
-            results_forward['volt_rate'] = volt_rate
-        elif results_reverse:
-            results_reverse['sweep_time'] = sweep_time
-            results_reverse['volt_rate'] = volt_rate
+        # each scan's time and rate from the timestamps of its points, data without them (older files) shares the
+        # time of the whole test between the scans by their number of points
+        points = len(data['voltages_forward']) + len(data['voltages_reverse'])
+        for scan, results in (('forward', results_forward), ('reverse', results_reverse)):
+            if not results:
+                continue
+            timing = calculate_timing(data['voltages_' + scan], data.get('timestamps_' + scan, []))
+            if not timing:
+                timing = {'sweep_time': sweep_time * len(data['voltages_' + scan]) / points, 'volt_rate': volt_rate}
+            results.update(timing)
+            results['spo_PCE'] = spo_pce
 
 
     except:
@@ -108,6 +148,20 @@ def update_output():
     gui.display_results(results_forward, results_reverse)
 
 
+def post_points(params: dict, voltages, currents):
+    """
+    Hand new points of a running test to the main thread for the live plot, write_event_value is thread safe.
+    Given to the tests bound to their profile with partial()
+
+    :param params: test parameters
+    :param voltages: volts
+    :param currents: milli-amps, plotted as current densities if the profile says so
+    """
+    if params['curr_density']:
+        currents = [curr / params['area'] for curr in currents]
+    window.write_event_value('-POINTS-', (voltages, currents))
+
+
 def threaded_IV():
     """
     Run an IV test and update the data dictionary. Performs all the communication with the Keithley.
@@ -115,63 +169,157 @@ def threaded_IV():
 
     :return: nothing
     """
-    global data, sweep_time, volt_rate
+    global data, sweep_time, volt_rate, io_rows, spo_pce
     params = gui.read_profile()
+    spo_pce = None
+
+    def pick_mpp(voltages, currents):
+        # hold the stabilized power output at V_mpp of the scan with the higher PCE
+        sweep_data = f.sort_data(voltages, [], currents, [], [], [])
+        scans = [calculate_params(sweep_data['voltages_' + direction], sweep_data['currents_' + direction],
+                                  params['area'], params['illum']) for direction in ('forward', 'reverse')]
+        scans = [results for results in scans if results and results['PCE']]
+        return max(scans, key=lambda results: results['PCE'])['V_mpp'] if scans else None
 
-    # this variable is monitored during the IV test and will be set to True if the user wants to cancel the test
-    # works across files and threads
-    comm.cancel_measure = False
+    # the test can be canceled from the gui thread with comm.cancel_tests()
     try:
-        voltages, currents, sweep_time, volt_rate = comm.run_IV_test(src_meter, params)
+        if params and params.get('spo_time'):
+            (voltages, currents, sweep_time, volt_rate, columns), (_, spo_volts, spo_currents) = \
+                comm.run_IV_SPO_test(src_meter, params, partial(post_points, params), pick_mpp)
+            spo_pce = calculate_spo(spo_volts, spo_currents, params['area'], params['illum'])
+        else:
+            voltages, currents, sweep_time, volt_rate, columns = comm.run_IV_test(src_meter, params,
+                                                                                  partial(post_points, params))
     except:
         print('Unhandled exception when running test - please report', c=gui.ERROR)
         print(traceback.format_exc(), c=gui.ERROR)
         voltages = []
         currents = []
+        columns = {}
 
     current_densities = [curr / params['area'] for curr in currents]
+    io_rows = comm.io_report(src_meter)
 
     # use file loading sort to split data from source meter
-    data = f.sort_data(voltages, [], currents, [], current_densities, [])
+    data = f.sort_data(voltages, [], currents, [], current_densities, [], columns)
     # notify main thread the test is complete
     window.write_event_value('-TEST-COMPLETE-', '')
 
 
+def threaded_pixels(switch, pixels: dict, params: dict):
+    """
+    Run an IV test on each pixel of a substrate through a switch system. Each pixel is handed to the main thread
+    with a '-PIXEL-' event to be calculated and saved while the next one is measured.
+    Supposed to be run as a separate thread.
+
+    :param switch: switch system as pyvisa object
+    :param pixels: pixel name: switch channels
+    :param params: test parameters, read before the thread starts
+    :return: nothing
+    """
+    remaining = [len(pixels)]
+
+    def post_pixel(pixel, voltages, currents, pixel_time, pixel_rate, columns):
+        remaining[0] -= 1
+        current_densities = [curr / params['area'] for curr in currents]
+        pixel_data = f.sort_data(voltages, [], currents, [], current_densities, [], columns)
+        window.write_event_value('-PIXEL-', (pixel, pixel_data, pixel_time, pixel_rate, comm.io_report(src_meter),
+                                             remaining[0]))
+
+    try:
+        comm.run_pixel_test(src_meter, switch, pixels, params, partial(post_points, params), post_pixel)
+    except:
+        print('Unhandled exception when running test - please report', c=gui.ERROR)
+        print(traceback.format_exc(), c=gui.ERROR)
+
+    window.write_event_value('-PIXELS-COMPLETE-', '')
+
+
+def threaded_batch(instruments: dict, params: dict):
+    """
+    Run an IV test on each instrument at once and store the data of each device in batch_runs.
+    Supposed to be run as a separate thread.
+
+    :param instruments: device name: Keithley as pyvisa object
+    :param params: test parameters, read by the main thread (see read_profile())
+    :return: nothing
+    """
+    global batch_runs
+
+    try:
+        runs = comm.run_IV_batch(instruments, params)
+    except:
+        print('Unhandled exception when running test - please report', c=gui.ERROR)
+        print(traceback.format_exc(), c=gui.ERROR)
+        runs = {}
+
+    batch_runs = {}
+    for device_name, (voltages, currents, device_time, device_rate, columns) in runs.items():
+        current_densities = [curr / params['area'] for curr in currents]
+        batch_runs[device_name] = (f.sort_data(voltages, [], currents, [], current_densities, [], columns),
+                                   device_time, device_rate, comm.io_report(instruments[device_name]))
+    window.write_event_value('-BATCH-COMPLETE-', '')
+
+
 def timer( ):
-    global data, sweep_time, volt_rate,x_time,y_PCE
-    global results_forward2, results_reverse2, values
+    global x_time,y_PCE
 
-    comm.cancel_measure = False
-    duration = 0.02  # hour
-    comm.connect_to_instrument()
     x_time=[] # define a y_time list to stor the time point
     y_PCE=[]
-    while (time.time() - start_time) / 3600 <= duration:
-        params = gui.read_profile2()
+    params = gui.read_profile2()
 
-        voltages, currents, sweep_time, volt_rate = comm.run_IV_test(src_meter, params)
+    try:
+        comm.run_lifespan_test(src_meter, params, params['duration'] if params else 0, on_sweep=record_sweep,
+                               on_track=record_track)
+    except:
+        print('Unhandled exception when running test - please report', c=gui.ERROR)
+        print(traceback.format_exc(), c=gui.ERROR)
 
+    window.write_event_value('-test-complete-', '')
 
-        current_densities = [curr / params['area'] for curr in currents]
+    return x_time, y_PCE
+
+
+def record_sweep(time_point, voltages, currents, elapsed, rate, columns):
+    """
+    Store a sweep of the lifetime test and its PCE. Called by comm.run_lifespan_test after each sweep
+
+    :param time_point: hours since the lifetime test started
+    :param voltages: volts
+    :param currents: milli-amps
+    :param elapsed: sweep time (s)
+    :param rate: volt rate (V/s)
+    :param columns: other per point data of the sweep, name: values
+    """
+    global data, sweep_time, volt_rate
+    global results_forward2
 
-        # use file loading sort to split data from source meter
-        data = f.sort_data(voltages, [], currents, [], current_densities, [])
+    sweep_time = elapsed
+    volt_rate = rate
+    current_densities = [curr / float(values['-area-']) for curr in currents]
 
+    # use file loading sort to split data from source meter
+    data = f.sort_data(voltages, [], currents, [], current_densities, [], columns)
 
-        results_forward2 = calculate_params(data['voltages_forward'], data['currents_forward'], float(values['-AREA-']),
-                                          float(values['-ILLUM-']))
+    results_forward2 = calculate_params(data['voltages_forward'], data['currents_forward'], float(values['-area-']),
+                                      float(values['-illum-']))
+    if not results_forward2:
+        return
 
-        time_point = (time.time() - start_time) / 3600
-        PCE = results_forward2['PCE']
-        x_time.append(time_point)
-        y_PCE.append(PCE)
-        if comm.cancel_measure ==True:
-            break
+    x_time.append(time_point)
+    y_PCE.append(results_forward2['PCE'])
 
-    else:
-        window.write_event_value('-test-complete-', '')
 
-    return x_time, y_PCE
+def record_track(time_point, voltage, current):
+    """
+    Store the PCE of a maximum power point tracking step. Called by comm.run_lifespan_test between sweeps
+
+    :param time_point: hours since the lifetime test started
+    :param voltage: volts
+    :param current: milli-amps
+    """
+    x_time.append(time_point)
+    y_PCE.append(-voltage * current / (float(values['-area-']) * float(values['-illum-'])) * 100)
 
 
 
@@ -255,8 +403,9 @@ while True:
             continue
 
         data = load_data
-        # todo: recovering sweep time and volt rate from loaded data
+        # sweep time and volt rate are recovered from the timestamps of the loaded data, if it has them
         sweep_time = volt_rate = 0
+        io_rows = spo_pce = None
         print('Confirm profile matches loaded data. If not, correct and reload', c=gui.WARNING)
         update_output()
 
@@ -275,6 +424,8 @@ while True:
         data_path, results_path = f.get_file_paths(user_dir, device_name, experiment_name)
 
         f.save_data(data_path, data)
+        if io_rows:
+            f.save_io_report(f.io_report_path(data_path), io_rows)
         # todo: profile may have been edited since loading/measuring data - should save 'old' profile?
         #       this behaviour is communicated to users via the Keithley User Manual
         f.save_results(results_path, experiment_name, results_forward, results_reverse, gui.read_profile())
@@ -283,19 +434,46 @@ while True:
         #output_key = MLINE_KEY if output_key == MLINE_KEY2 else MLINE_KEY
         #sg.cprint_set_output_destination(window, output_key)
 
-        src_meter = comm.connect_to_instrument()
+        instruments = dict(gui.advanced_profile.get('instruments') or {})
+        if instruments:
+            # multi-instrument profile: sweep every device at once, device names come from the profile
+            src_meters = connect_instruments(instruments)
+            if not src_meters:
+                continue
+            gui.disable_profile(True)
+            plotter.disable()
+            thread1 = threading.Thread(target=threaded_batch, args=(src_meters, gui.read_profile(values)))
+            thread1.start()
+            continue
 
+        src_meter = connect_instrument()
         if not src_meter:
             continue
-        if not comm.test_communication(src_meter):
+
+        pixels = dict(gui.advanced_profile.get('pixels') or {})
+        if pixels:
+            # substrate profile: scan every pixel through the switch system
+            switch = comm.connect_switch(gui.advanced_profile.get('switch_resource'), src_meter)
+            if not switch:
+                continue
+            gui.disable_profile(True)
+            plotter.disable()
+            plotter.start_live_plot(window, show_density=values['-CURR-DENSITY-'])
+            thread1 = threading.Thread(target=threaded_pixels, args=(switch, pixels, gui.read_profile(values)))
+            thread1.start()
             continue
+
         # grey out and disable sections of gui during tests
         gui.disable_profile(True)
         plotter.disable()
+        plotter.start_live_plot(window, show_density=values['-CURR-DENSITY-'])
         # run IV test in separate thread
         thread1 = threading.Thread(target=threaded_IV)
         thread1.start()
 
+    if event == '-POINTS-':
+        plotter.plot_points(*values[event])
+
     if event == '-TEST-COMPLETE-':
         thread1.join(10)
         if thread1.is_alive():
@@ -306,8 +484,72 @@ while True:
         if autosave:
             window.write_event_value('-SAVE-DATA-', '')
 
+    if event == '-BATCH-COMPLETE-':
+        thread1.join(10)
+        if thread1.is_alive():
+            print('Error joining test thread - Please report this', c=gui.ERROR)
+        gui.disable_profile(False)
+        plotter.enable()
+
+        experiment_name = gui.read_file_info(values)[1]
+        if autosave and not (user_dir and experiment_name):
+            print('Select User Directory and enter Experiment Name to save batch data', c=gui.ERROR)
+
+        # each device gets its own results and files, the last device stays on the plot
+        spo_pce = None
+        for device_name, (data, sweep_time, volt_rate, io_rows) in batch_runs.items():
+            update_output(values)
+            if results_forward or results_reverse:
+                pce = results_forward['PCE'] if results_forward else results_reverse['PCE']
+                print(f'{device_name}: PCE {round(pce, 2)}%, sweep time {round(sweep_time, 2)}s')
+            if autosave and user_dir and experiment_name:
+                data_path, results_path = f.get_file_paths(user_dir, device_name, experiment_name)
+                f.save_data(data_path, data)
+                f.save_io_report(f.io_report_path(data_path), io_rows)
+                f.save_results(results_path, experiment_name, results_forward, results_reverse,
+                               gui.read_profile(values))
+        # the data on the plot belongs to the last device, not to the device name in the window, Save Data must not
+        # write it under that name
+        data = {name: [] for name in data}
+        results_forward, results_reverse = {}, {}
+        sweep_time = volt_rate = 0
+        io_rows = None
+
+    if event == '-PIXEL-':
+        # calculate and save a pixel while the test thread moves on to the next one
+        # the scan thread is still posting events, so the window is not read again here (see read_profile())
+        pixel, data, sweep_time, volt_rate, io_rows, remaining = values[event]
+        spo_pce = None
+        update_output(values)
+        if results_forward or results_reverse:
+            pce = results_forward['PCE'] if results_forward else results_reverse['PCE']
+            print(f'{pixel}: PCE {round(pce, 2)}%, sweep time {round(sweep_time, 2)}s')
+        device_name, experiment_name = gui.read_file_info(values)
+        if autosave and user_dir and device_name and experiment_name:
+            data_path, results_path = f.get_file_paths(user_dir, device_name, experiment_name + ' ' + pixel)
+            f.save_data(data_path, data)
+            f.save_io_report(f.io_report_path(data_path), io_rows)
+            f.save_results(results_path, experiment_name + ' ' + pixel, results_forward, results_reverse,
+                           gui.read_profile(values))
+        if remaining:
+            plotter.start_live_plot(window, show_density=values['-CURR-DENSITY-'])
+
+    if event == '-PIXELS-COMPLETE-':
+        thread1.join(10)
+        if thread1.is_alive():
+            print('Error joining test thread - Please report this', c=gui.ERROR)
+        gui.disable_profile(False)
+        plotter.enable()
+        device_name, experiment_name = gui.read_file_info()
+        if autosave and not (user_dir and device_name and experiment_name):
+            print('Select User Directory and enter Device and Experiment Name to save pixel data', c=gui.ERROR)
+
     if event in ('Cancel', '-CANCEL-'):
-        comm.cancel_measure = True
+        comm.cancel_tests()
+
+    if event == 'Find Instruments':
+        instruments = comm.list_instruments(refresh=True)
+        print('Found instruments: ' + (', '.join(instruments) if instruments else 'none'))
 
     if event == 'Choose Spec File':
         # todo: validate spec file (ie can't load profile as spec)
@@ -349,11 +591,9 @@ while True:
         start_time = time.time()
         #output_key = MLINE_KEY2 if output_key == MLINE_KEY else MLINE_KEY2
         #sg.cprint_set_output_destination(window, output_key)
-        src_meter = comm.connect_to_instrument()
+        src_meter = connect_instrument()
         if not src_meter:
             continue
-        if not comm.test_communication(src_meter):
-            continue
         # grey out and disable sections of gui during tests
             # run IV test in separate thread
         thread2 = threading.Thread(target=timer)
@@ -371,7 +611,7 @@ while True:
 
 
     if event in ('Cancel', '-cancel-'):
-        comm.cancel_measure = True
+        comm.cancel_tests()
 
     if event == '-choose-user-':
         directory_path = askdirectory(title='Select Your Folder')
@@ -410,8 +650,9 @@ while True:
             continue
 
         data = load_data
-        # todo: recovering sweep time and volt rate from loaded data
+        # sweep time and volt rate are recovered from the timestamps of the loaded data, if it has them
         sweep_time = volt_rate = 0
+        io_rows = spo_pce = None
         print('Confirm profile matches loaded data. If not, correct and reload', c=gui.WARNING)
         update_output()
 
@@ -430,11 +671,14 @@ while True:
         data_path, results_path = f.get_file_paths(user_dir, device_name, experiment_name)
 
         f.save_data(data_path, data)
+        if io_rows:
+            f.save_io_report(f.io_report_path(data_path), io_rows)
         # todo: profile may have been edited since loading/measuring data - should save 'old' profile?
         #       this behaviour is communicated to users via the Keithley User Manual
         f.save_results(results_path, experiment_name, results_forward, results_reverse, gui.read_profile())
 
 
+comm.disconnect_all()  # release the instrument sessions
 window.close()  # destroy GUI window
 
 sys.exit(0)  # exit program safely
@@ -24,6 +24,11 @@ axes.grid()
 figure_canvas_agg = None
 toolbar = None
 
+# points of a running test, drawn as they arrive
+live_line = None
+live_voltages = []
+live_currents = []
+
 
 # todo: combine disable and enable functions?
 def disable():
@@ -57,10 +62,59 @@ def create_figure_w_toolbar(canvas, canvas_toolbar):
     figure_canvas_agg.get_tk_widget().pack(side='right', fill='both', expand=1)
 
 
+def start_live_plot(window, show_density=False):
+    """
+    Clear the plot for the points of a new test, added with plot_points()
+    """
+    global live_line, live_voltages, live_currents
+    if not window:
+        return
+
+    for line in axes.get_lines():
+        line.remove()
+    legend = axes.get_legend()
+    if legend:
+        legend.remove()
+
+    axes.axhline(0, color='black')
+    axes.axvline(0, c='black')
+    axes.set_ylabel("Current Density (mA/cm2)" if show_density else "Current (mA)")
+    axes.set_autoscale_on(True)
+
+    live_voltages = []
+    live_currents = []
+    live_line, = axes.plot(live_voltages, live_currents, 'b.', label='measuring')
+
+    if not figure_canvas_agg:
+        create_figure_w_toolbar(window['-GRAPH-'].TKCanvas, window['-GRAPH-CONTROLS-'].TKCanvas)
+    figure_canvas_agg.draw()
+
+
+def plot_points(voltages: list, currents: list):
+    """
+    Add points to the live plot. The line keeps the same lists and only the new points are appended
+
+    :param voltages: volts
+    :param currents: milli-amps or mA/cm2, same as start_live_plot()
+    """
+    if not live_line or not figure_canvas_agg:
+        return
+
+    live_voltages.extend(voltages)
+    live_currents.extend(currents)
+    live_line.set_data(live_voltages, live_currents)
+    axes.relim()
+    axes.autoscale_view()
+    figure_canvas_agg.draw_idle()  # redraws once tkinter is idle, so a burst of points is drawn together
+
+
 def plot_data(window, data, show_density=False):
     if not window or not data or not (data['voltages_forward'] or data['voltages_reverse']):
         return
 
+    global live_line
+    live_line = None
+
     # clear lines without full reset of plot
     lines = axes.get_lines()
     for line in lines:
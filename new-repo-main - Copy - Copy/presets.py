@@ -0,0 +1,38 @@
+"""
+Rayleigh Solar Tech
+
+Source Meter UI project
+presets.py
+
+Acquisition speed presets and how a profile resolves them, shared by communication.py and file_io.py without the
+file handling depending on the instrument driver
+
+Created on: October 18th, 2026
+"""
+
+# acquisition speed presets: integration time (power line cycles), autozero and whether the current range is fixed
+# at the current limit instead of auto ranging. nplc, autozero and curr_range in the profile override the preset
+acquisition_presets = {'fast': {'nplc': 0.01, 'autozero': 'OFF', 'fixed_range': True},
+                       'normal': {'nplc': 1.0, 'autozero': 'ON', 'fixed_range': False},
+                       'precise': {'nplc': 10.0, 'autozero': 'ON', 'fixed_range': False}}
+
+
+def acquisition_options(profile):
+    """
+    Integration time, autozero and current range of a test: the profile's speed preset, overridden by whichever of
+    nplc, autozero and curr_range the profile gives
+
+    :param profile: test parameters
+    :return: dict of speed, nplc (power line cycles), autozero ('ON' or 'OFF') and curr_range (mA, 0 to auto range)
+    """
+    speed = profile.get('speed') or 'normal'
+    preset = acquisition_presets[speed]
+
+    curr_range = profile.get('curr_range')
+    if curr_range is None:
+        curr_range = abs(float(profile['curr_limit'])) if preset['fixed_range'] else 0
+
+    return {'speed': speed,
+            'nplc': float(profile.get('nplc') or preset['nplc']),
+            'autozero': (profile.get('autozero') or preset['autozero']).upper(),
+            'curr_range': abs(float(curr_range))}
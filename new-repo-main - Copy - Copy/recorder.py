@@ -0,0 +1,232 @@
+"""
+Rayleigh Solar Tech
+
+Source Meter UI project
+recorder.py
+
+Recorded instrument sessions: every SCPI transaction of a test saved with its response and timing, and a replay
+backend that serves the responses back to communication.py so production sweeps can be reproduced offline.
+Record by setting record_dir in the profile, replay by setting resource_name to REPLAY::<file>
+
+Created on: October 18th, 2026
+"""
+
+import base64
+import gzip
+import json
+import time
+from datetime import datetime
+
+import numpy as np
+import pyvisa
+
+# version of the file format, the first line of every recording
+file_version = 2  # 2 records the clock readings the tests decide on
+
+
+def encode_response(response):
+    """
+    Make a pyvisa response JSON serializable, NumPy arrays from binary transfers are stored as base64 bytes
+
+    :param response: str, NumPy array or None
+    :return: JSON serializable value
+    """
+    if isinstance(response, np.ndarray):
+        return {'dtype': response.dtype.str, 'data': base64.b64encode(response.tobytes()).decode('ascii')}
+    return response
+
+
+def decode_response(response):
+    """
+    Reverse encode_response()
+
+    :param response: value from a recording
+    :return: str, NumPy array or None
+    """
+    if isinstance(response, dict) and 'dtype' in response:
+        return np.frombuffer(base64.b64decode(response['data']), dtype=response['dtype']).copy()
+    return response
+
+
+def save_session(file_path: str, transactions: list, kind: str):
+    """
+    Write a recorded session as gzipped JSON lines: a header, then one line per transaction of
+    [time since start (s), latency (s), pyvisa method, program message, response]. A transaction that failed has
+    {'error': VISA status code} as response and one cut short by a cancellation has {'canceled': True}. A
+    cancellation is also marked where it landed by a line with method 'cancel', see communication.cancel_tests(),
+    and each time the test read the clock there is a line with method 'clock' and the reading as response, see
+    communication.clock()
+
+    :param file_path: path of the recording, usually ending .jsonl.gz
+    :param transactions: transactions in the order they went out
+    :param kind: test that was recorded, e.g. 'iv' or 'lifetime'
+    """
+    with gzip.open(file_path, 'wt', encoding='utf-8') as file:
+        header = {'version': file_version, 'kind': kind, 'saved': datetime.now().isoformat(timespec='seconds'),
+                  'transactions': len(transactions)}
+        file.write(json.dumps(header) + '\n')
+        for sent, latency, method, message, response in transactions:
+            line = [round(sent, 6), round(latency, 6), method, message, encode_response(response)]
+            file.write(json.dumps(line, separators=(',', ':')) + '\n')
+
+
+def load_session(file_path: str):
+    """
+    Read a recording written by save_session()
+
+    :param file_path: path of the recording
+    :return: header and list of transactions
+    """
+    with gzip.open(file_path, 'rt', encoding='utf-8') as file:
+        header = json.loads(file.readline())
+        if header.get('version') != file_version:
+            raise ValueError(f'Unsupported recording version {header.get("version")}')
+        transactions = [json.loads(line) for line in file if line.strip()]
+    for transaction in transactions:
+        transaction[4] = decode_response(transaction[4])
+    return header, transactions
+
+
+class ReplayError(pyvisa.errors.VisaIOError):
+    """
+    The code asked for something other than the next transaction of the recording, or the recording ran out.
+    A VisaIOError so tests handle it like a communication failure
+    """
+
+    def __init__(self, message: str):
+        super().__init__(pyvisa.constants.StatusCode.error_connection_lost)
+        self.args = (message,)
+
+    def __str__(self):
+        return self.args[0]
+
+
+class ReplayKeithley:
+    """
+    Stands in for the pyvisa resource returned by connect_to_instrument(), answering each write and query with the
+    next transaction of a recording. The program messages must match the recording, so the replayed test has to
+    run with the profile it was recorded with. With original timing each transaction takes as long as it did when
+    recorded, with zero timing it returns straight away along with the delays the test makes itself (settle times,
+    waiting on a scan, intervals between lifetime sweeps). Loops bounded by time (the longest adaptive settle, the
+    length of a lifetime test) read the recorded clock, see clock(), so they follow the recording with either timing
+    """
+
+    def __init__(self, file_path: str, timing: str = 'original', on_cancel=None):
+        """
+        :param file_path: recording written by save_session()
+        :param timing: 'original' or 'zero'
+        :param on_cancel: called when a cancellation is reached in the recording, so the test is canceled at the
+                          same point
+        """
+        self.file_path = file_path
+        self.header, self.transactions = load_session(file_path)
+        self.timing = timing
+        self.on_cancel = on_cancel
+        self.position = 0
+        self.diverged = False  # set once a ReplayError is raised, the rest of the recording cannot be followed
+
+        self.timeout = 2000  # ms, same default as pyvisa
+        self.read_termination = '\n'
+        self.write_termination = '\n'
+        self.closed = False
+
+    # ----- pyvisa resource interface -----
+
+    def write(self, message: str):
+        self.replay('write', message)
+        return len(message)
+
+    def query(self, message: str):
+        if message == '*IDN?' and not self.next_is('query', message):
+            return 'KEITHLEY INSTRUMENTS INC.,MODEL 2420,0000000,C34 (replay of ' + self.file_path + ')'
+        return self.replay('query', message)
+
+    def query_binary_values(self, message: str, datatype: str = 'f', is_big_endian: bool = False, container=list,
+                            **kwargs):
+        values = self.replay('query_binary_values', message)
+        return container(values) if values is not None else None
+
+    def read_stb(self):
+        self.check_open()
+        if self.position >= len(self.transactions):
+            # an exhausted replay no longer counts as alive, so connecting again starts it over
+            raise ReplayError('End of recording')
+        return 0
+
+    def clear(self):
+        self.check_open()
+
+    def open(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    # ----- replay -----
+
+    def clock(self):
+        """
+        :return: the next clock reading of the recording (s)
+        """
+        return self.replay('clock', '')
+
+    def host_delay(self, delay: float):
+        """
+        :param delay: time the test waits on the host (s)
+        :return: how long to wait in the replay (s)
+        """
+        return delay if self.timing == 'original' else 0.0
+
+    def check_open(self):
+        if self.closed:
+            raise pyvisa.errors.InvalidSession()
+
+    def next_is(self, method: str, message: str):
+        """
+        :return: True if the next transaction of the recording is method with message
+        """
+        if self.position >= len(self.transactions):
+            return False
+        transaction = self.transactions[self.position]
+        return transaction[2] == method and transaction[3] == message
+
+    def replay(self, method: str, message: str):
+        """
+        Take the next transaction of the recording, checking it is the one the code asked for
+
+        :param method: pyvisa method called
+        :param message: program message sent
+        :return: recorded response
+        """
+        self.check_open()
+        if self.next_is('cancel', ''):
+            # canceled before this transaction went out, or while it was on the bus. The test reads the clock on
+            # until it reaches its next await, where the cancellation lands
+            self.position += 1
+            if self.on_cancel:
+                self.on_cancel()
+            if method != 'clock':
+                if self.next_is(method, message) and self.transactions[self.position][4] == {'canceled': True}:
+                    self.position += 1
+                return None
+        if self.position >= len(self.transactions):
+            self.diverged = True
+            raise ReplayError(f'End of recording, {method} {message!r} was not recorded')
+        if not self.next_is(method, message):
+            _, _, recorded_method, recorded_message, _ = self.transactions[self.position]
+            self.diverged = True
+            raise ReplayError(f'Replay diverged at transaction {self.position + 1}: recorded {recorded_method} '
+                              f'{recorded_message!r}, got {method} {message!r}')
+
+        _, latency, _, _, response = self.transactions[self.position]
+        self.position += 1
+        if self.timing == 'original' and latency:
+            time.sleep(latency)
+
+        if isinstance(response, dict) and 'error' in response:
+            raise pyvisa.errors.VisaIOError(response['error'])
+        if isinstance(response, dict) and response.get('canceled'):
+            if self.on_cancel:
+                self.on_cancel()
+            return None
+        return response
@@ -0,0 +1,465 @@
+"""
+Rayleigh Solar Tech
+
+Source Meter UI project
+simulator.py
+
+Simulated Keithley 2420 SMU with a solar cell connected, for testing and benchmarking communication.py without
+the instrument. Use it by setting the profile resource_name to SIM
+
+Created on: October 18th, 2026
+"""
+
+import time
+
+import numpy as np
+import pyvisa
+
+# single diode model of the simulated cell (roughly a 0.2 cm2 perovskite cell under 1 sun)
+default_cell = {'light_current': 4.5e-3,  # photo-generated current (A)
+                'saturation_current': 3e-14,  # diode reverse saturation current (A)
+                'ideality': 1.5,  # diode ideality factor
+                'series_resistance': 20.0,  # Ohm
+                'shunt_resistance': 5e4,  # Ohm
+                'temperature': 298.15}  # K
+
+BOLTZMANN_OVER_CHARGE = 8.617333e-5  # V/K
+
+# value the Keithley returns for elements that were not measured
+NOT_MEASURED = 9.91e37
+# most points the source list memory holds
+list_size = 100
+
+
+class SimulatedKeithley2420:
+    """
+    Stands in for the pyvisa resource returned by connect_to_instrument(). Implements the SCPI subset used by
+    communication.py: settings are stored as sent, :READ?, :INIT and the trace buffer generate readings from a
+    single diode model with gaussian noise. Every bus transaction sleeps for the configured latency and every
+    reading takes its source delay plus integration time, so test timings are comparable with the real instrument.
+    After a change of source level the current relaxes exponentially to the new value, like a cell's capacitance
+    """
+
+    def __init__(self, cell: dict = None, noise: float = 1e-4, noise_floor: float = 1e-8, latency: float = 2e-3,
+                 line_frequency: float = 60.0, settle_tau: float = 2e-3, fault_rate: float = 0.0, seed: int = None):
+        """
+        :param cell: single diode model parameters, see default_cell
+        :param noise: standard deviation of current noise relative to the current
+        :param noise_floor: standard deviation of current noise independent of the current (A)
+        :param latency: time taken by each write and query on the bus (s)
+        :param line_frequency: power line frequency the integration time is based on (Hz)
+        :param settle_tau: time constant of the current after a change of source level (s), 0 to settle instantly
+        :param fault_rate: chance of each bus transaction timing out, to test recovery from bus faults
+        :param seed: seed for the noise, for repeatable readings
+        """
+        self.cell = dict(default_cell, **(cell or {}))
+        self.noise = noise
+        self.noise_floor = noise_floor
+        self.latency = latency
+        self.line_frequency = line_frequency
+        self.settle_tau = settle_tau
+        self.fault_rate = fault_rate
+        self.rng = np.random.default_rng(seed)
+
+        self.timeout = 2000  # ms, same default as pyvisa
+        self.read_termination = '\n'
+        self.write_termination = '\n'
+
+        self.closed = False
+        self.commands = 0  # number of bus transactions, for benchmarking
+        self.settings = {}
+        self.errors = []
+        self.buffer = []  # readings stored in the trace buffer
+        self.fetched = []  # readings from the latest trigger model run, returned by :FETC?
+        self.busy_until = 0.0  # the trigger model runs in the background until this time
+        self.level_change = (0.0, 0.0)  # time of the last source level change and the current before it (A)
+        self.start_time = time.perf_counter()
+        self.reset()
+
+    # ----- pyvisa resource interface -----
+
+    def write(self, message: str):
+        self.transaction()
+        for command in message.split(';'):
+            if command.strip():
+                self.execute(command.strip())
+        return len(message)
+
+    def query(self, message: str):
+        self.transaction()
+        responses = []
+        for command in message.split(';'):
+            command = command.strip()
+            if not command:
+                continue
+            response = self.execute(command)
+            if response is not None:
+                responses.append(response)
+        return ';'.join(self.format_response(response) for response in responses)
+
+    def query_binary_values(self, message: str, datatype: str = 'f', is_big_endian: bool = False, container=list,
+                            **kwargs):
+        self.transaction()
+        values = None
+        for command in message.split(';'):
+            if command.strip():
+                response = self.execute(command.strip())
+                if response is not None:
+                    values = response
+        if not isinstance(values, np.ndarray):
+            raise ValueError('Response is not a block of readings')
+
+        # go through the same bytes as the instrument so decoding costs the same
+        dtype = ('>' if is_big_endian else '<') + datatype
+        values = np.frombuffer(values.astype(dtype).tobytes(), dtype=dtype)
+        return container(values)
+
+    def read_stb(self):
+        self.transaction()
+        return 0
+
+    def clear(self):
+        self.check_open()
+        self.busy_until = 0.0
+
+    def open(self):
+        self.closed = False  # like the real instrument, reopening the session keeps its settings
+
+    def close(self):
+        self.closed = True
+
+    # ----- instrument -----
+
+    def check_open(self):
+        if self.closed:
+            raise pyvisa.errors.InvalidSession()
+
+    def transaction(self):
+        self.check_open()
+        self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fault_rate and self.rng.random() < self.fault_rate:
+            # the message is lost, the host waits out its timeout
+            time.sleep(self.timeout / 1000 if self.timeout is not None else 0)
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+
+    def wait_until_idle(self):
+        """
+        Block like a query does while the trigger model is still running, times out like a pyvisa query
+        """
+        remaining = self.busy_until - time.perf_counter()
+        if remaining <= 0:
+            return
+        if self.timeout is not None and remaining > self.timeout / 1000:
+            time.sleep(self.timeout / 1000)
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)
+        time.sleep(remaining)
+
+    def reset(self):
+        self.settings = {':SOUR:FUNC': 'VOLT', ':SOUR:VOLT:MODE': 'FIX', ':SOUR:VOLT:LEV': '0',
+                         ':SOUR:VOLT:STAR': '0', ':SOUR:VOLT:STOP': '0', ':SOUR:VOLT:STEP': '0',
+                         ':SOUR:LIST:VOLT': '0', ':SOUR:DEL': '0', ':SOUR:DEL:AUTO': 'ON', ':SENS:CURR:PROT': '1.05e-4',
+                         ':SENS:CURR:NPLC': '1', ':SENS:CURR:RANG': '1.05e-4', ':SENS:CURR:RANG:AUTO': 'ON',
+                         ':SYST:AZER': 'ON', ':TRIG:COUN': '1', ':TRIG:DEL': '0', ':OUTP': 'OFF',
+                         ':FORM:ELEM': 'VOLT,CURR,RES,TIME,STAT', ':FORM:DATA': 'ASC', ':FORM:BORD': 'NORM',
+                         ':TRAC:POIN': '100', ':TRAC:FEED': 'SENS', ':TRAC:FEED:CONT': 'NEV'}
+        self.buffer = []
+        self.fetched = []
+        self.busy_until = 0.0
+
+    def execute(self, command: str):
+        """
+        Run one SCPI command
+
+        :param command: command with parameters, short form headers
+        :return: response for queries, None otherwise
+        """
+        header, _, value = command.partition(' ')
+        header = header.upper()
+        value = value.strip()
+
+        if header == '*RST':
+            self.reset()
+        elif header == '*CLS':
+            self.errors = []
+        elif header == '*IDN?':
+            return 'KEITHLEY INSTRUMENTS INC.,MODEL 2420,0000000,C34 (simulated)'
+        elif header == '*OPC?':
+            self.wait_until_idle()
+            return '1'
+        elif header == ':SYST:ERR?':
+            return self.errors.pop(0) if self.errors else '0,"No error"'
+        elif header == ':READ?':
+            self.wait_until_idle()
+            self.settings[':OUTP'] = 'ON'
+            return self.format_readings(self.trigger())
+        elif header == ':INIT':
+            self.wait_until_idle()
+            self.fetched = self.trigger(wait=False)
+        elif header == ':FETC?':
+            self.wait_until_idle()
+            return self.format_readings(self.fetched)
+        elif header == ':ABOR':
+            now = time.perf_counter()
+            self.busy_until = min(self.busy_until, now)
+            self.buffer = [reading for reading in self.buffer if reading[2] <= now - self.start_time]  # taken so far
+        elif header == ':TRAC:CLE':
+            self.buffer = []
+        elif header == ':TRAC:DATA?':
+            self.wait_until_idle()
+            return self.format_readings(self.buffer)
+        elif header == ':TRAC:POIN:ACT?':
+            self.wait_until_idle()
+            return str(len(self.buffer))
+        elif header.endswith('?'):
+            if header[:-1] not in self.settings:
+                self.errors.append('-113,"Undefined header"')
+                return ''
+            return self.settings[header[:-1]]
+        elif header == ':SOUR:LIST:VOLT' and value.count(',') >= list_size:
+            self.errors.append('-223,"Too much data"')
+        elif value:
+            if header == ':SOUR:VOLT:LEV' and self.settle_tau:
+                before = self.cell_current(np.array([float(self.settings[header])]))[0]
+                self.level_change = (time.perf_counter(), before)
+            self.settings[header] = value
+        else:
+            self.errors.append('-109,"Missing parameter"')
+        return None
+
+    def source_points(self):
+        """
+        Voltages sourced by one run of the trigger model
+
+        :return: NumPy array of voltages (V)
+        """
+        count = int(float(self.settings[':TRIG:COUN']))
+        if self.settings[':SOUR:VOLT:MODE'] == 'SWE':
+            start = float(self.settings[':SOUR:VOLT:STAR'])
+            stop = float(self.settings[':SOUR:VOLT:STOP'])
+            return np.linspace(start, stop, count)
+        if self.settings[':SOUR:VOLT:MODE'] == 'LIST':
+            voltages = np.array(self.settings[':SOUR:LIST:VOLT'].split(','), dtype=float)
+            return np.resize(voltages, count)  # the list repeats when the trigger count is longer
+        return np.full(count, float(self.settings[':SOUR:VOLT:LEV']))
+
+    def reading_time(self):
+        """
+        Time taken by each reading: trigger delay, source delay and integration, doubled by autozero
+
+        :return: seconds
+        """
+        delay = 1e-3 if self.settings[':SOUR:DEL:AUTO'] == 'ON' else float(self.settings[':SOUR:DEL'])
+        delay += float(self.settings[':TRIG:DEL'])
+        integration = float(self.settings[':SENS:CURR:NPLC']) / self.line_frequency
+        if self.settings[':SYST:AZER'] == 'ON':
+            integration *= 2
+        return delay + integration
+
+    def trigger(self, wait: bool = True):
+        """
+        Run the trigger model: source and measure each point, storing readings in the trace buffer if enabled
+
+        :param wait: block for the acquisition time, like :READ?, instead of running in the background like :INIT
+        :return: list of readings (voltage, current, time, status)
+        """
+        voltages = self.source_points()
+        step_time = self.reading_time()
+        start = max(time.perf_counter(), self.busy_until)
+        times = start - self.start_time + step_time * np.arange(1, len(voltages) + 1)
+
+        currents = self.cell_current(voltages)
+        if self.settings[':SOUR:VOLT:MODE'] == 'FIX' and self.settle_tau:
+            changed_at, before = self.level_change
+            since_change = np.maximum(start + step_time * np.arange(1, len(voltages) + 1) - changed_at, 0)
+            currents = currents + (before - currents) * np.exp(-since_change / self.settle_tau)
+        currents = self.add_noise(currents)
+        limit = abs(float(self.settings[':SENS:CURR:PROT']))
+        in_compliance = np.abs(currents) >= limit
+        currents = np.clip(currents, -limit, limit)
+        status = np.where(in_compliance, 8.0 + 2048.0, 2048.0)  # compliance bit, always on in voltage source mode
+
+        readings = list(zip(voltages, currents, times, status))
+
+        if self.settings[':TRAC:FEED:CONT'] == 'NEXT':
+            space = int(float(self.settings[':TRAC:POIN'])) - len(self.buffer)
+            self.buffer += readings[:max(space, 0)]
+            if len(self.buffer) >= int(float(self.settings[':TRAC:POIN'])):
+                self.settings[':TRAC:FEED:CONT'] = 'NEV'
+
+        self.busy_until = start + step_time * len(voltages)
+        if wait:
+            self.wait_until_idle()
+        return readings
+
+    def cell_current(self, voltages):
+        """
+        Current into the cell at each voltage, solved from the single diode equation by bisection
+
+        :param voltages: NumPy array of sourced voltages (V)
+        :return: NumPy array of currents (A), negative when the cell is generating power
+        """
+        cell = self.cell
+        thermal_voltage = cell['ideality'] * BOLTZMANN_OVER_CHARGE * cell['temperature']
+
+        def residual(currents):
+            junction = voltages - currents * cell['series_resistance']
+            diode = cell['saturation_current'] * np.expm1(np.minimum(junction / thermal_voltage, 200))
+            return diode + junction / cell['shunt_resistance'] - cell['light_current'] - currents
+
+        # residual decreases with current, so bracket the root and bisect every point at once
+        low = np.full(voltages.shape, -cell['light_current'] - np.abs(voltages).max() / cell['shunt_resistance'] - 1)
+        high = np.full(voltages.shape, np.abs(voltages).max() / cell['series_resistance'] + 1)
+        for _ in range(60):
+            middle = (low + high) / 2
+            positive = residual(middle) > 0
+            low = np.where(positive, middle, low)
+            high = np.where(positive, high, middle)
+        return (low + high) / 2
+
+    def add_noise(self, currents):
+        """
+        :param currents: NumPy array of currents (A)
+        :return: currents with gaussian measurement noise added, noise is set for 1 PLC and falls with the square
+                 root of the integration time
+        """
+        scale = (self.noise * np.abs(currents) + self.noise_floor) / np.sqrt(float(self.settings[':SENS:CURR:NPLC']))
+        return currents + self.rng.normal(0, 1, currents.shape) * scale
+
+    def format_readings(self, readings: list):
+        """
+        Arrange readings as the Keithley sends them for the configured :FORM:ELEM
+
+        :param readings: list of (voltage, current, time, status)
+        :return: NumPy array for binary formats, comma separated string for ascii
+        """
+        elements = self.settings[':FORM:ELEM'].upper().split(',')
+        columns = {'VOLT': 0, 'CURR': 1, 'TIME': 2, 'STAT': 3}
+        values = [reading[columns[element]] if element in columns else NOT_MEASURED
+                  for reading in readings for element in elements]
+
+        if self.settings[':FORM:DATA'].upper() in ('SRE', 'SREAL', 'DRE', 'DREAL'):
+            return np.array(values, dtype=float)
+        return ','.join(f'{value:+.6E}' for value in values)
+
+    @staticmethod
+    def format_response(response):
+        if isinstance(response, np.ndarray):
+            raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_nonsupported_format)
+        return response
+
+
+# cell the SMU sees through a switch with no channel closed
+open_circuit = dict(default_cell, light_current=0.0, saturation_current=0.0, shunt_resistance=1e12)
+
+
+class SimulatedSwitch:
+    """
+    Stands in for a Keithley 7001/7002 style switch system routing one SMU to the pixels of a substrate. Implements
+    :ROUT:CLOS, :ROUT:OPEN, :ROUT:OPEN:ALL and :ROUT:CLOS?. Closing a channel connects the simulated SMU to the cell
+    scripted for that channel in pixels, other channels get the SMU's own cell with its light current varied by up to
+    spread. With no channel closed the SMU sees an open circuit. Use it by setting the profile switch_resource to SIM
+    """
+
+    def __init__(self, smu: SimulatedKeithley2420 = None, pixels: dict = None, spread: float = 0.1,
+                 latency: float = 2e-3, switch_time: float = 5e-3, seed: int = None):
+        """
+        :param smu: simulated SMU whose cell is switched, None to only log the routes
+        :param pixels: channel: single diode model parameters overriding the SMU's cell, see default_cell
+        :param spread: largest relative change of light current of channels not in pixels
+        :param latency: time taken by each write and query on the bus (s)
+        :param switch_time: time the relays take to operate (s)
+        :param seed: seed for the variation between pixels, for repeatable pixels
+        """
+        self.smu = smu
+        self.base_cell = dict(smu.cell) if smu else dict(default_cell)
+        self.pixels = dict(pixels or {})
+        self.spread = spread
+        self.latency = latency
+        self.switch_time = switch_time
+        self.rng = np.random.default_rng(seed)
+
+        self.timeout = 2000  # ms, same default as pyvisa
+        self.closed = False
+        self.channels = []  # closed channels in the order they were closed
+        self.routes = []  # channels closed by each route change, for testing
+        self.connect()
+
+    # ----- pyvisa resource interface -----
+
+    def write(self, message: str):
+        self.transaction()
+        before = list(self.channels)
+        for command in message.split(';'):
+            if command.strip():
+                self.execute(command.strip())
+        if self.channels != before:
+            self.routes.append(tuple(self.channels))
+            self.connect()
+            time.sleep(self.switch_time)
+        return len(message)
+
+    def query(self, message: str):
+        self.transaction()
+        if message.strip().upper() == ':ROUT:CLOS?':
+            return '(@' + ','.join(self.channels) + ')'
+        raise pyvisa.errors.VisaIOError(pyvisa.constants.StatusCode.error_timeout)  # no response to anything else
+
+    def read_stb(self):
+        self.transaction()
+        return 0
+
+    def clear(self):
+        self.check_open()
+
+    def open(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    # ----- switch -----
+
+    def check_open(self):
+        if self.closed:
+            raise pyvisa.errors.InvalidSession()
+
+    def transaction(self):
+        self.check_open()
+        if self.latency:
+            time.sleep(self.latency)
+
+    def execute(self, command: str):
+        """
+        Run one SCPI command, channel lists are given as (@1!1,1!2)
+
+        :param command: command with parameters
+        """
+        header, _, value = command.partition(' ')
+        header = header.upper()
+        channels = [channel.strip() for channel in value.strip().strip('(@)').split(',') if channel.strip()]
+
+        if header in (':ROUT:OPEN:ALL', '*RST'):
+            self.channels = []
+        elif header == ':ROUT:CLOS':
+            self.channels += [channel for channel in channels if channel not in self.channels]
+        elif header == ':ROUT:OPEN':
+            self.channels = [channel for channel in self.channels if channel not in channels]
+
+    def pixel_cell(self, channel: str):
+        """
+        :param channel: switch channel, e.g. 1!1
+        :return: single diode model parameters of the pixel on the channel
+        """
+        if channel not in self.pixels:
+            variation = 1 + self.spread * self.rng.uniform(-1, 1)
+            self.pixels[channel] = {'light_current': self.base_cell['light_current'] * variation}
+        return dict(self.base_cell, **self.pixels[channel])
+
+    def connect(self):
+        """
+        Connect the SMU to the pixel of the first closed channel
+        """
+        if self.smu:
+            self.smu.cell = self.pixel_cell(self.channels[0]) if self.channels else dict(open_circuit)
@@ -54,6 +54,9 @@ ERROR = 'red2'
 
 window = None
 
+# profile settings without a gui element, taken from the most recently loaded profile
+advanced_profile = {}
+
 
 def alert(*args, **kwargs):
     """
@@ -114,7 +117,7 @@ def init_gui():
 
     sg.theme("SystemDefault")
 
-    menu_def = [['Config', ['Choose Spec File', 'Toggle Autosave']]]
+    menu_def = [['Config', ['Choose Spec File', 'Toggle Autosave', 'Find Instruments']]]
 
     profile_frame = sg.Frame('', [[text_long('Device Area (cm2)'), Push(), input_number(key='-AREA-')],
                                   [text_long('Current Limit (mA)'), Push(), input_number(key='-CURR-LIMIT-')],
@@ -136,7 +139,7 @@ def init_gui():
                                   [text_long('Voltage Settle Time (s)'), Push(), input_number(key='-settle-time-')],
                                   [text_long('Illumination (mW/cm2)'), Push(), input_number(key='-illum-')],
                                   [text_long('Hysteresis'), Push(), checkbox(key='-hysteresis-')],
-                                  [text_long('')],
+                                  [text_long('MPP Tracking'), Push(), checkbox(key='-mpp-tracking-')],
                                   [text_long('Duration (Hours)'), Push(), input_number(key='-duar')]],
 
                              border_width=bw, expand_x=True, pad=(0, 0))
@@ -173,6 +176,8 @@ def init_gui():
                                    statusbar_number(key='-I_MPP-R-', visible=False)],
                                   [text_long('PCE (%)'), Push(), statusbar_number(key='-PCE-'),
                                    statusbar_number(key='-PCE-R-', visible=False)],
+                                  [text_long('SPO PCE (%)'), Push(), statusbar_number(key='-SPO-'),
+                                   statusbar_number(key='-SPO-R-', visible=False)],
                                   [text_long('Fill factor (%)'), Push(), statusbar_number(key='-FF-'),
                                    statusbar_number(key='-FF-R-', visible=False)],
                                   [text_long('Sweep Time (s)'), Push(), statusbar_number(key='-ST-'),
@@ -277,9 +282,15 @@ def init_gui():
 
 
 
-def read_profile():
+def read_profile(values: dict = None):
+    """
+    :param values: values of the window from the event loop, read from the window if not given. Pass them while a
+                   test thread is posting events, window.read() would take its next event off the queue
+    :return: test parameters, None if a value is invalid
+    """
     assert isinstance(window, sg.Window)  # asserts in these functions to disable warnings about window being None
-    values = window.read(0)[1]
+    if values is None:
+        values = window.read(0)[1]
     profile = None
     try:
         profile = {'area': float(values['-AREA-']),
@@ -291,6 +302,7 @@ def read_profile():
                    'illum': float(values['-ILLUM-']),
                    'hysteresis': values['-HYSTERESIS-'],
                    'curr_density': values['-CURR-DENSITY-']}
+        profile.update(advanced_profile)
     except ValueError:
         print('Invalid value in profile', c=ERROR)
     else:
@@ -306,14 +318,17 @@ def read_profile2():
     profile = None
     try:
         profile = {'area': float(values['-area-']),
-                   'curr_limit': float(values['-curr-limit-']),
-                   'start_volt': float(values['-start-volt-']),
+                   'curr_limit': float(values['-current-limit-']),
+                   'start_volt': float(values['-start-volt']),
                    'stop_volt': float(values['-stop-volt-']),
-                   'volt_step': float(values['-volt-step-']),
+                   'volt_step': float(values['-voltage-step-']),
                    'settle_time': float(values['-settle-time-']),
                    'illum': float(values['-illum-']),
                    'hysteresis': values['-hysteresis-'],
-                   'curr_density': values['-curr-density-']}
+                   'curr_density': False,
+                   'mpp_tracking': values['-mpp-tracking-'],
+                   'duration': float(values['-duar'])}
+        profile.update(advanced_profile)
     except ValueError:
         print('Invalid value in profile', c=ERROR)
     else:
@@ -357,6 +372,7 @@ def display_results(results_forward: dict, results_reverse: dict):
         window['-V_MPP-'].update(round(results_forward['V_mpp'], precision))
         window['-I_MPP-'].update(round(results_forward['I_mpp'], precision))
         window['-PCE-'].update(round(results_forward['PCE'], precision))
+        window['-SPO-'].update(spo_text(results_forward, precision))
         window['-FF-'].update(round(results_forward['FF'], precision))
         window['-ST-'].update(round(results_forward['sweep_time'], precision + 1))
         window['-V_R-'].update(round(results_forward['volt_rate'], precision + 1))
@@ -369,11 +385,20 @@ def display_results(results_forward: dict, results_reverse: dict):
         window['-V_MPP-R-'].update(round(results_reverse['V_mpp'], precision))
         window['-I_MPP-R-'].update(round(results_reverse['I_mpp'], precision))
         window['-PCE-R-'].update(round(results_reverse['PCE'], precision))
+        window['-SPO-R-'].update(spo_text(results_reverse, precision))
         window['-FF-R-'].update(round(results_reverse['FF'], precision))
         window['-ST-R-'].update(round(results_reverse['sweep_time'], precision + 1))
         window['-V_R-R-'].update(round(results_reverse['volt_rate'], precision + 1))
 
 
+def spo_text(results: dict, precision: int):
+    """
+    :return: stabilized power output PCE of the results rounded for display, blank if none was captured
+    """
+    spo_pce = results.get('spo_PCE')
+    return '' if spo_pce is None else round(spo_pce, precision)
+
+
 def change_results_visibility(show_forward: bool, show_reverse: bool):
     assert isinstance(window, sg.Window)
 
@@ -388,6 +413,7 @@ def change_results_visibility(show_forward: bool, show_reverse: bool):
     window['-V_MPP-'].update(visible=show_forward)
     window['-I_MPP-'].update(visible=show_forward)
     window['-PCE-'].update(visible=show_forward)
+    window['-SPO-'].update(visible=show_forward)
     window['-FF-'].update(visible=show_forward)
     window['-ST-'].update(visible=show_forward)
     window['-V_R-'].update(visible=show_forward)
@@ -400,14 +426,20 @@ def change_results_visibility(show_forward: bool, show_reverse: bool):
     window['-V_MPP-R-'].update(visible=show_reverse)
     window['-I_MPP-R-'].update(visible=show_reverse)
     window['-PCE-R-'].update(visible=show_reverse)
+    window['-SPO-R-'].update(visible=show_reverse)
     window['-FF-R-'].update(visible=show_reverse)
     window['-ST-R-'].update(visible=show_reverse)
     window['-V_R-R-'].update(visible=show_reverse)
 
 
-def read_file_info():
+def read_file_info(values: dict = None):
+    """
+    :param values: values of the window from the event loop, read from the window if not given, see read_profile()
+    :return: device name and experiment name
+    """
     assert isinstance(window, sg.Window)
-    values = window.read(0)[1]
+    if values is None:
+        values = window.read(0)[1]
 
     device_name = values['-DEVICE-NAME-'].strip()
     experiment_name = values['-EXPERIMENT-NAME-'].strip()
@@ -0,0 +1,132 @@
+"""
+Rayleigh Solar Tech
+
+Source Meter UI project
+test_communication.py
+
+Regression tests for communication.py against the simulated Keithley (simulator.py), run with pytest from this
+folder. The simulator keeps real time, each test takes a few seconds
+
+Created on: October 18th, 2026
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+import communication as comm
+import recorder
+import simulator
+from calculations import calculate_params
+
+profile = {'area': 0.2, 'curr_limit': 20, 'start_volt': -0.2, 'stop_volt': 1.2, 'volt_step': 0.05,
+           'settle_time': 0.005, 'illum': 100, 'hysteresis': True, 'curr_density': False, 'speed': 'fast'}
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    """
+    The alerts go to the GUI, which the tests do not open
+    """
+    monkeypatch.setattr(comm, 'print', lambda *args, **kwargs: None)
+
+
+def forward_pce(voltages, currents):
+    forward = len(voltages) // 2
+    return calculate_params(list(voltages[:forward]), list(currents[:forward]), profile['area'],
+                            profile['illum'])['PCE']
+
+
+@pytest.mark.parametrize('sweep_mode', ['point', 'sweep', 'list', 'adaptive'])
+def test_sweep_modes(sweep_mode):
+    sim = simulator.SimulatedKeithley2420(seed=1)
+    voltages, currents, elapsed, volt_rate, columns = comm.run_IV_test(sim, dict(profile, sweep_mode=sweep_mode))
+
+    assert len(voltages) == len(currents) > 0
+    assert voltages.min() == pytest.approx(-0.2) and voltages.max() == pytest.approx(1.2)
+    assert voltages[-1] == pytest.approx(-0.2)  # back down again with hysteresis
+    assert set(columns) == set(comm.point_columns) - {'voltages', 'currents'}
+    assert columns['timestamps'].min() >= 0  # adaptive sweeps return the points in voltage order, not in time
+    assert elapsed > 0 and volt_rate > 0
+    assert 10 < forward_pce(voltages, currents) < 25
+    assert sim.settings[':OUTP'] == 'OFF'
+
+
+def test_sweep_modes_agree():
+    results = {}
+    for sweep_mode in ('point', 'sweep'):
+        sim = simulator.SimulatedKeithley2420(seed=1)
+        voltages, currents, *_ = comm.run_IV_test(sim, dict(profile, sweep_mode=sweep_mode))
+        results[sweep_mode] = forward_pce(voltages, currents)
+    assert results['point'] == pytest.approx(results['sweep'], rel=0.02)
+
+
+@pytest.mark.parametrize('sweep_mode', ['point', 'sweep'])
+def test_cancel(sweep_mode):
+    sim = simulator.SimulatedKeithley2420(seed=1)
+    timer = threading.Timer(0.3, comm.cancel_tests)
+    timer.start()
+    voltages, *_ = comm.run_IV_test(sim, dict(profile, sweep_mode=sweep_mode, volt_step=0.01))
+    timer.join()
+
+    assert len(voltages) < 2 * 141  # both scans would be 141 points
+    assert sim.settings[':OUTP'] == 'OFF'
+    assert not comm.running_tests and not comm.canceled_tests
+
+
+def test_cancel_twice():
+    sim = simulator.SimulatedKeithley2420(seed=1)
+    timers = [threading.Timer(delay, comm.cancel_tests) for delay in (0.3, 0.36)]
+    for timer in timers:
+        timer.start()
+    voltages, *_ = comm.run_IV_test(sim, dict(profile, sweep_mode='point', volt_step=0.01))
+    for timer in timers:
+        timer.join()
+
+    assert 0 < len(voltages)
+    assert sim.settings[':OUTP'] == 'OFF'
+
+
+@pytest.mark.parametrize('sweep_mode', ['point', 'sweep', 'list'])
+def test_compliance_escalation(sweep_mode):
+    # the cell gives about 4.5mA, more than the 3mA limit, from the first point on
+    low_limit = dict(profile, sweep_mode=sweep_mode, curr_limit=3)
+
+    sim = simulator.SimulatedKeithley2420(seed=1)
+    stopped, *_ = comm.run_IV_test(sim, low_limit)
+
+    sim = simulator.SimulatedKeithley2420(seed=1)
+    voltages, currents, _, _, columns = comm.run_IV_test(sim, dict(low_limit, compliance_step=2,
+                                                                     compliance_ceiling=9))
+
+    assert len(stopped) < len(voltages)
+    assert voltages.max() == pytest.approx(1.2)
+    assert 4.5 < columns['compliances'].max() <= 9
+    assert np.all(np.abs(currents) < columns['compliances'])
+
+
+@pytest.mark.parametrize('sweep_mode', ['point', 'sweep', 'adaptive'])
+def test_voc_stop(sweep_mode):
+    sim = simulator.SimulatedKeithley2420(seed=1)
+    voltages, currents, *_ = comm.run_IV_test(sim, dict(profile, sweep_mode=sweep_mode, volt_step=0.02,
+                                                        voc_margin=0.1))
+
+    v_oc = calculate_params(list(voltages), list(currents), profile['area'], profile['illum'])['V_oc']
+    step = 0.02 * 5 if sweep_mode == 'adaptive' else 0.02  # adaptive sweeps stop on their coarse scan
+    assert v_oc < voltages.max() <= v_oc + 0.1 + step
+    assert voltages.max() < 1.2
+    assert sim.settings[':OUTP'] == 'OFF'
+
+
+def test_replay(tmp_path):
+    sim = simulator.SimulatedKeithley2420(seed=1)
+    recorded = comm.run_IV_test(sim, dict(profile, sweep_mode='adaptive', settle_mode='adaptive',
+                                          record_dir=str(tmp_path)))
+    file_path = str(next(tmp_path.iterdir()))
+
+    replay = recorder.ReplayKeithley(file_path, 'zero', on_cancel=comm.cancel_tests)
+    replayed = comm.run_IV_test(replay, dict(profile, sweep_mode='adaptive', settle_mode='adaptive'))
+
+    assert np.array_equal(recorded[0], replayed[0]) and np.array_equal(recorded[1], replayed[1])
+    assert replay.position == len(replay.transactions) and not replay.diverged